@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Long running agent that loads every check plugin once and runs checks on
+request over a Unix domain socket. Each request is handled by a forked child,
+killed when it runs over the timeout. See check_client.py.
+"""
+
+import argparse
+import errno
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+
+from sys import exit
+from time import time
+
+from plugins import OK, UNKNOWN, PLUGINS, load_plugins, run_plugin
+
+
+REQUEST_MAX_SIZE = 65536
+PATH_OPTIONS = ('--state-file', '--state-dir')         # plugin options naming files to write.
+
+
+
+def default_socket():
+    ''' check_agent.sock in $XDG_RUNTIME_DIR, or in a check_agent.<uid> directory of the temporary directory. '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+
+    if runtime_dir:
+        return runtime_dir.rstrip('/') + '/check_agent.sock'
+
+    return '%s/check_agent.%d/check_agent.sock' % (os.environ.get('TMPDIR', '/tmp').rstrip('/'), os.getuid())
+
+
+def private_dir(path):
+    ''' Creates directory path for the current user alone, or checks that an existing one is. Raises OSError otherwise. '''
+    try:
+        os.mkdir(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    info = os.lstat(path)
+
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 077:
+        raise OSError(errno.EPERM, 'not a private directory', path)
+
+
+def send_response(connection, status, stdout, stderr=''):
+    ''' Writes a response and shuts the connection down, so the client sees its end even if other processes hold it. '''
+    try:
+        connection.sendall('%d %d\n%s%s' % (status, len(stdout), stdout, stderr))
+        connection.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+def read_request(connection):
+    ''' A request is the plugin name and its arguments separated by NUL bytes, ended by the client shutting down its side. '''
+    data = ''
+
+    while len(data) <= REQUEST_MAX_SIZE:
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    else:
+        raise ValueError('request over %d bytes' % REQUEST_MAX_SIZE)
+
+    if not data:
+        raise ValueError('empty request')
+
+    fields = data.split('\0')
+
+    return fields[0], fields[1:]
+
+
+def path_argument(argv):
+    '''
+    Returns the first argument that would make a plugin read or write a file of
+    the caller's choice: --state-file, --state-dir or an abbreviation of them,
+    and @FILE lists of check_netstat targets. None when there is no such one.
+    '''
+    for arg in argv:
+        name = arg.split('=', 1)[0]
+
+        if len(name) > 2 and name.startswith('--') and any(option.startswith(name) for option in PATH_OPTIONS):
+            return arg
+
+        if '@' in arg:
+            return arg
+
+    return None
+
+
+def handle_request(connection, plugins):
+    ''' Runs in the forked child, never returns. '''
+    try:
+        name, argv = read_request(connection)
+    except (socket.error, ValueError) as e:
+        send_response(connection, UNKNOWN, 'ERROR: invalid request: %s\n' % e)
+        os._exit(0)
+
+    if name not in plugins:
+        send_response(connection, UNKNOWN, 'ERROR: unknown plugin %s.\n' % name)
+        os._exit(0)
+
+    argument = path_argument(argv)
+    if argument is not None:
+        send_response(connection, UNKNOWN, 'ERROR: argument %s not allowed through the agent.\n' % argument)
+        os._exit(0)
+
+    sys.argv = [name + '.py'] + argv                    # program name in argparse messages.
+    status, stdout, stderr = run_plugin(plugins[name], argv)
+
+    send_response(connection, status, stdout, stderr)
+    os._exit(0)
+
+
+def reap_children(children):
+    ''' Forgets children that exited, closing the parent side of their connection. '''
+    for pid in children.keys():
+        try:
+            done, wait_status = os.waitpid(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            done = pid
+
+        if done:
+            children.pop(pid)[1].close()
+
+
+def kill_overdue(children, timeout):
+    now = time()
+
+    for pid, (deadline, connection) in children.items():
+        if now >= deadline:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+            send_response(connection, UNKNOWN, 'ERROR: check timed out after %d seconds.\n' % timeout)
+
+
+def bind_socket(path):
+    ''' Listens on path, replacing a socket file left by a previous agent. '''
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0660)
+    listener.listen(128)
+
+    return listener
+
+
+def serve(plugins, path, timeout, max_children):
+    listener = bind_socket(path)
+    children = {}                                       # pid: (deadline, connection).
+
+    try:
+        while True:
+            reap_children(children)
+            kill_overdue(children, timeout)
+
+            if children:
+                wait = max(min(deadline for deadline, connection in children.itervalues()) - time(), 0)
+                wait = min(wait, 0.1)                   # also reaps finished children.
+            else:
+                wait = None
+
+            readable = [listener] if len(children) < max_children else []
+
+            try:
+                ready = select.select(readable, [], [], wait)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not ready:
+                continue
+
+            connection = listener.accept()[0]
+            pid = os.fork()
+
+            if pid == 0:
+                listener.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                handle_request(connection, plugins)
+
+            children[pid] = (time() + timeout, connection)
+
+    finally:
+        listener.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def terminate(signum, frame):
+    exit(OK)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="""Agent that loads the check
+    plugins once and runs them on request of check_client.py over a Unix domain
+    socket, without starting a Python interpreter per check.
+    """)
+
+    parser.add_argument('-S', '--socket', action='store', dest='socket', type=str, default=default_socket(),
+        help='Path of the Unix domain socket. Default is check_agent.sock in $XDG_RUNTIME_DIR, or in a private '
+             'check_agent.<uid> directory of $TMPDIR or /tmp.')
+    parser.add_argument('-t', '--timeout', action='store', dest='timeout', type=int, default=60,
+        help='Seconds a check may run before it is killed and reported UNKNOWN. Default is 60.')
+    parser.add_argument('--max-children', action='store', dest='max_children', type=int, default=32,
+        help='Number of checks run at the same time, further requests wait. Default is 32.')
+    parser.add_argument('--version', action='version', version='%(prog)s 0.1.0')
+
+    arguments = parser.parse_args(argv)
+
+    if arguments.timeout < 1 or arguments.max_children < 1:
+        print 'ERROR: timeout and max children must be at least 1.'
+        exit(UNKNOWN)
+
+    try:
+        plugins = load_plugins(PLUGINS)
+    except (IOError, ImportError, SyntaxError) as e:
+        print 'ERROR: Fail while loading plugins: %s' % e
+        exit(UNKNOWN)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        if arguments.socket == default_socket():
+            private_dir(os.path.dirname(arguments.socket))
+        serve(plugins, arguments.socket, arguments.timeout, arguments.max_children)
+    except (socket.error, OSError) as e:
+        print 'ERROR: %s' % e
+        exit(UNKNOWN)
+    except KeyboardInterrupt:
+        exit(OK)
+
+
+
+if __name__ == '__main__':
+    main()
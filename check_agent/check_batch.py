@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Runs a batch of checks from one process, each in a forked child started by a
+thread of its own, so plugins are loaded once and checks do not share their
+globals. Checks that sample twice share one sampling window: all first
+samples are taken when the batch starts and the total run time is the
+longest interval, not their sum.
+"""
+
+import argparse
+import os
+import shlex
+import socket
+import stat
+import sys
+import threading
+import time
+
+from sys import exit
+
+from plugins import OK, WARNING, CRITICAL, UNKNOWN, PLUGINS, Pipe, load_plugins, run_forked
+
+
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+SEVERITY = [OK, UNKNOWN, WARNING, CRITICAL]
+
+
+
+class SharedWindow(object):
+    '''
+    Replaces the sleep() of the plugins. The first sleep of a check, when it
+    comes within SLACK seconds of the start of the batch, is counted from the
+    start instead of from the moment it is called, so checks sampling over
+    the same interval take their samples at the same time. Other sleeps last
+    as long as asked, a sample taken late is never given a shorter interval.
+    '''
+
+    SLACK = 0.1
+
+    def __init__(self):
+        self.start = time.time()
+        self.local = threading.local()
+
+    def sleep(self, seconds):
+        now = time.time()
+
+        if not getattr(self.local, 'slept', False) and now - self.start <= self.SLACK:
+            seconds = max(self.start + seconds - now, 0)
+
+        self.local.slept = True
+        time.sleep(seconds)
+
+    def install(self, plugins):
+        for plugin in plugins.itervalues():
+            if hasattr(plugin, 'sleep'):
+                plugin.sleep = self.sleep
+
+
+def parse_spec(spec):
+    ''' A check spec is "[service=]plugin [arguments]", ie: "root_disk=check_disk -m /". '''
+    words = shlex.split(spec, comments=True)
+
+    if not words:
+        return None
+
+    service, _, plugin = words[0].rpartition('=')
+
+    return service or plugin, plugin, words[1:]
+
+
+def read_specs(specs, spec_file):
+    lines = list(specs)
+
+    if spec_file:
+        with open(spec_file, 'r') as data_file:
+            lines.extend(data_file.readlines())
+
+    return [check for check in (parse_spec(line) for line in lines) if check]
+
+
+def run_batch(checks, plugins, timeout):
+    '''
+    Runs checks, a list of (service, plugin, argv), in forked children. Returns
+    a list of (service, status, output) in the same order. Checks still running
+    after timeout seconds are killed and reported UNKNOWN.
+    '''
+    results = [None] * len(checks)
+
+    window = SharedWindow()
+    window.install(plugins)
+
+    def run(index, service, plugin, argv):
+        result = run_forked(plugins[plugin], argv, timeout)
+
+        if result is not None:
+            status, stdout, stderr = result
+            results[index] = (service, status, stdout + stderr)
+
+    threads = []
+
+    for index, (service, plugin, argv) in enumerate(checks):
+        if plugin not in plugins:
+            results[index] = (service, UNKNOWN, 'ERROR: unknown plugin %s.\n' % plugin)
+            continue
+
+        thread = threading.Thread(target=run, args=(index, service, plugin, argv))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+
+    for index, (service, plugin, argv) in enumerate(checks):
+        if results[index] is None:
+            results[index] = (service, UNKNOWN, 'ERROR: check timed out after %d seconds.\n' % timeout)
+
+    return results
+
+
+def passive_result(hostname, service, status, output, timestamp=None):
+    ''' A result in Icinga/Nagios external command format, long output lines escaped. '''
+    output = output.rstrip('\n').replace('\n', '\\n')
+
+    return '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (
+        timestamp or time.time(), hostname, service, status, output)
+
+
+def multiline_result(service, status, output):
+    return '%s %s: %s\n' % (STATE_NAMES[status] if 0 <= status < len(STATE_NAMES) else 'UNKNOWN', service, output.rstrip('\n'))
+
+
+def append_output(path, output):
+    ''' Appends to a file, or writes to a named pipe in whole lines that other writers can not split. '''
+    try:
+        fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        fifo = False
+
+    if fifo:
+        Pipe(path).write(output)
+    else:
+        with open(path, 'a') as data_file:
+            data_file.write(output)
+
+
+def worst_status(results):
+    status = OK
+
+    for service, check_status, output in results:
+        if check_status not in SEVERITY:
+            check_status = UNKNOWN
+        if SEVERITY.index(check_status) > SEVERITY.index(status):
+            status = check_status
+
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="""Runs a batch of checks in a
+    single process and prints one result per check, as multi-line output or as
+    passive check results for the Icinga/Nagios command file. A check is given
+    as "[service=]plugin [arguments]", ie: "root_disk=check_disk -m /".
+    """)
+
+    parser.add_argument('checks', nargs='*', metavar='CHECK',
+        help='Check to run, quoted: "[service=]plugin [arguments]".')
+    parser.add_argument('-f', '--file', action='store', dest='file', type=str,
+        help='File with one check per line, # starts a comment.')
+    parser.add_argument('-F', '--format', action='store', dest='format', choices=['multiline', 'passive'], default='multiline',
+        help='Output format. Default is multiline, exiting with the worst state.')
+    parser.add_argument('-H', '--hostname', action='store', dest='hostname', type=str, default=socket.gethostname(),
+        help='Host name of passive check results. Default is the local host name.')
+    parser.add_argument('-o', '--output', action='store', dest='output', type=str,
+        help='Append results to this file (ie: the Icinga command pipe) instead of printing them.')
+    parser.add_argument('-t', '--timeout', action='store', dest='timeout', type=int, default=60,
+        help='Seconds to wait for the checks, the ones still running are reported UNKNOWN. Default is 60.')
+    parser.add_argument('--version', action='version', version='%(prog)s 0.1.0')
+
+    arguments = parser.parse_args(argv)
+
+    try:
+        checks = read_specs(arguments.checks, arguments.file)
+    except (IOError, ValueError) as e:
+        print 'ERROR: %s' % e
+        exit(UNKNOWN)
+
+    if not checks:
+        print 'ERROR: no checks given.'
+        exit(UNKNOWN)
+
+    plugins = load_plugins(set(plugin for service, plugin, check_argv in checks if plugin in PLUGINS))
+    results = run_batch(checks, plugins, arguments.timeout)
+
+    if arguments.format == 'passive':
+        now = time.time()
+        output = ''.join(passive_result(arguments.hostname, service, status, check_output, now)
+            for service, status, check_output in results)
+    else:
+        output = ''.join(multiline_result(*result) for result in results)
+
+    if arguments.output:
+        try:
+            append_output(arguments.output, output)
+        except (IOError, OSError) as e:
+            print 'ERROR: %s' % e
+            exit(UNKNOWN)
+    else:
+        sys.stdout.write(output)
+
+    exit(OK if arguments.format == 'passive' else worst_status(results))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python -S
+
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Thin client of check_agent.py: asks the agent to run a check and prints its
+output, exiting with its status like the plugin itself would. Runs once per
+check, so it starts with python -S and only imports the builtin _socket and
+posix modules: socket.py alone would double its start up time.
+
+Usage: check_client.py [-S SOCKET] [-t TIMEOUT] plugin [arguments]
+"""
+
+import _socket
+import posix
+import sys
+
+
+UNKNOWN = 3
+USAGE = 'usage: check_client.py [-S SOCKET] [-t TIMEOUT] plugin [arguments]\n'
+
+
+
+def default_socket():
+    runtime_dir = posix.environ.get('XDG_RUNTIME_DIR')
+
+    if runtime_dir:
+        return runtime_dir.rstrip('/') + '/check_agent.sock'
+
+    return '%s/check_agent.%d/check_agent.sock' % (posix.environ.get('TMPDIR', '/tmp').rstrip('/'), posix.getuid())
+
+
+def request_check(path, plugin, argv, timeout):
+    ''' Sends a request to the agent, returns its status, standard output and standard error. '''
+    client = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    client.settimeout(timeout)
+
+    try:
+        client.connect(path)
+        client.sendall('\0'.join([plugin] + argv))
+        client.shutdown(_socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+
+    header, data = ''.join(chunks).split('\n', 1)
+    status, stdout_size = header.split()
+    stdout_size = int(stdout_size)
+
+    return int(status), data[:stdout_size], data[stdout_size:]
+
+
+def main(argv):
+    path, timeout = default_socket(), 90.0
+
+    try:
+        while argv[0] in ('-S', '-t'):
+            if argv[0] == '-S':
+                path = argv[1]
+            else:
+                timeout = float(argv[1])
+            argv = argv[2:]
+        plugin = argv[0]
+    except (IndexError, ValueError):
+        sys.stderr.write(USAGE)
+        sys.exit(UNKNOWN)
+
+    try:
+        owner = posix.lstat(path).st_uid
+    except OSError as e:
+        sys.stdout.write('ERROR: Fail while connecting to agent: %s\n' % e)
+        sys.exit(UNKNOWN)
+
+    if owner not in (posix.getuid(), 0):                # anyone else may answer what they like.
+        sys.stdout.write('ERROR: agent socket %s is owned by uid %d, not by us.\n' % (path, owner))
+        sys.exit(UNKNOWN)
+
+    try:
+        status, stdout, stderr = request_check(path, plugin, argv[1:], timeout)
+    except _socket.timeout:
+        sys.stdout.write('ERROR: no answer from agent after %d seconds.\n' % timeout)
+        sys.exit(UNKNOWN)
+    except _socket.error as e:
+        sys.stdout.write('ERROR: Fail while connecting to agent: %s\n' % e)
+        sys.exit(UNKNOWN)
+    except ValueError as e:
+        sys.stdout.write('ERROR: invalid answer from agent: %s\n' % e)
+        sys.exit(UNKNOWN)
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(status)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
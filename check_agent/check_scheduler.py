@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Runs checks locally on their own intervals and spools the results as passive
+check results, for Icinga/Nagios to ingest in bulk. Checks run in a pool of
+worker threads fed by a bounded queue, each run in a forked child killed when
+it runs over the timeout, see run_forked(). When the workers or the consumer of the results fall
+behind, runs and results are dropped and counted instead of piling up.
+"""
+
+import argparse
+import heapq
+import os
+import Queue
+import random
+import signal
+import socket
+import threading
+import time
+
+from sys import exit
+
+from check_batch import parse_spec, passive_result
+from plugins import OK, UNKNOWN, PLUGINS, Pipe, load_plugins, run_forked
+
+
+
+class Spool(object):
+    ''' Appends lines to a file, renamed to file.1 (and file.1 to file.2...) when it grows over max_bytes. '''
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+
+    def write(self, data):
+        try:
+            if os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self.rotate()
+        except OSError:
+            pass
+
+        with open(self.path, 'a') as data_file:
+            data_file.write(data)
+
+
+class Scheduler(object):
+
+    def __init__(self, checks, plugins, writer, hostname, workers, queue_size, jitter, stats_interval, timeout):
+        self.checks = checks                            # list of (interval, service, plugin, argv).
+        self.plugins = plugins
+        self.writer = writer
+        self.hostname = hostname
+        self.workers = workers
+        self.timeout = timeout
+        self.jitter = jitter
+        self.stats_interval = stats_interval
+
+        self.jobs = Queue.Queue(queue_size)
+        self.results = Queue.Queue(queue_size)
+        self.running = set()
+        self.children = set()                           # pids of the forked checks.
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.stats = dict.fromkeys(['runs', 'dropped_runs', 'skipped_runs', 'timed_out_runs', 'dropped_results', 'write_errors'], 0)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def put_result(self, service, status, output):
+        ''' Queues a result for the writer, dropping it when the writer is behind. '''
+        try:
+            self.results.put_nowait(passive_result(self.hostname, service, status, output))
+        except Queue.Full:
+            self.count('dropped_results')
+
+    def run_check(self, plugin, argv):
+        ''' Runs a check in a forked child, killed after timeout seconds. Returns status, stdout, stderr. '''
+        result = run_forked(self.plugins[plugin], argv, self.timeout, self.children)
+
+        if result is None:
+            self.count('timed_out_runs')
+            return UNKNOWN, 'ERROR: check timed out after %d seconds.\n' % self.timeout, ''
+
+        return result
+
+    def worker(self):
+        while not self.stop.is_set():
+            try:
+                index = self.jobs.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            interval, service, plugin, argv = self.checks[index]
+
+            if plugin in self.plugins:
+                status, stdout, stderr = self.run_check(plugin, argv)
+            else:
+                status, stdout, stderr = UNKNOWN, 'ERROR: unknown plugin %s.\n' % plugin, ''
+
+            with self.lock:
+                self.running.discard(index)
+
+            self.count('runs')
+            self.put_result(service, status, stdout + stderr)
+
+    def writer_loop(self):
+        while not (self.stop.is_set() and self.results.empty()):
+            try:
+                lines = [self.results.get(timeout=0.5)]
+            except Queue.Empty:
+                continue
+
+            while len(lines) < 1000:                    # write what is queued in one go.
+                try:
+                    lines.append(self.results.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self.writer.write(''.join(lines))
+            except (IOError, OSError):
+                self.count('write_errors')
+                with self.lock:
+                    self.stats['dropped_results'] += len(lines)
+                self.stop.wait(1)
+
+    def stats_result(self):
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats['queued_runs'] = self.jobs.qsize()
+        stats['queued_results'] = self.results.qsize()
+        perfdata = ''.join('\'%s\'=%d ' % (k, v) for k, v in sorted(stats.iteritems()))
+
+        self.put_result('check_scheduler', OK, 'Scheduler OK %d run(s), %d dropped run(s), %d dropped result(s) | %s' % (
+            stats['runs'], stats['dropped_runs'], stats['dropped_results'], perfdata))
+
+    def next_run(self, due, interval):
+        return due + interval + random.uniform(-self.jitter, self.jitter) * interval
+
+    def schedule(self):
+        ''' Puts checks on the jobs queue when due. A check still running or not fitting the queue skips its run. '''
+        now = time.time()
+        heap = [(now + random.uniform(0, interval), index) for index, (interval, service, plugin, argv) in enumerate(self.checks)]
+        heapq.heapify(heap)
+
+        if self.stats_interval:
+            heapq.heappush(heap, (now + self.stats_interval, None))
+
+        while not self.stop.is_set():
+            due, index = heap[0]
+
+            if self.stop.wait(max(due - time.time(), 0)) or self.stop.is_set():
+                break
+
+            if index is None:
+                self.stats_result()
+                heapq.heapreplace(heap, (due + self.stats_interval, None))
+                continue
+
+            with self.lock:
+                running = index in self.running
+                if not running:
+                    self.running.add(index)
+
+            if running:
+                self.count('skipped_runs')
+            else:
+                try:
+                    self.jobs.put_nowait(index)
+                except Queue.Full:
+                    with self.lock:
+                        self.running.discard(index)
+                    self.count('dropped_runs')
+
+            interval = self.checks[index][0]
+            heapq.heapreplace(heap, (max(self.next_run(due, interval), time.time()), index))
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker) for i in range(self.workers)]
+        writer = threading.Thread(target=self.writer_loop)
+
+        for thread in threads + [writer]:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            self.schedule()
+        finally:
+            self.stop.set()
+
+            for pid in list(self.children):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+            writer.join(5)
+
+
+def read_checks(path):
+    ''' One check per line: "interval [service=]plugin [arguments]", # starts a comment. '''
+    checks = []
+
+    with open(path, 'r') as data_file:
+        for number, line in enumerate(data_file, 1):
+            fields = line.split(None, 1)
+            if not fields or fields[0].startswith('#'):
+                continue
+
+            try:
+                interval = float(fields[0])
+                service, plugin, argv = parse_spec(fields[1])
+            except (ValueError, IndexError, TypeError):
+                raise ValueError('invalid check at %s line %d' % (path, number))
+
+            if interval <= 0:
+                raise ValueError('interval must be greater than zero at %s line %d' % (path, number))
+
+            checks.append((interval, service, plugin, argv))
+
+    return checks
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="""Runs checks on their own
+    intervals and appends the results, as passive check results, to a rotating
+    spool file or to the Icinga/Nagios command pipe. Checks are read from a file
+    with one "interval [service=]plugin [arguments]" per line, ie:
+    "300 root_disk=check_disk -m /".
+    """)
+
+    parser.add_argument('-f', '--file', action='store', dest='file', type=str, required=True,
+        help='File with one check per line, # starts a comment.')
+    parser.add_argument('-s', '--spool', action='store', dest='spool', type=str,
+        help='Spool file the results are appended to.')
+    parser.add_argument('-p', '--pipe', action='store', dest='pipe', type=str,
+        help='Named pipe the results are written to, ie: the Icinga command pipe.')
+    parser.add_argument('--max-bytes', action='store', dest='max_bytes', type=int, default=10485760,
+        help='Size in bytes after which the spool file is rotated. Default is 10485760.')
+    parser.add_argument('--backups', action='store', dest='backups', type=int, default=3,
+        help='Number of rotated spool files kept. Default is 3.')
+    parser.add_argument('-H', '--hostname', action='store', dest='hostname', type=str, default=socket.gethostname(),
+        help='Host name of passive check results. Default is the local host name.')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', type=int, default=4,
+        help='Number of checks run at the same time. Default is 4.')
+    parser.add_argument('-q', '--queue-size', action='store', dest='queue_size', type=int, default=1000,
+        help='Size of the queues of pending runs and of pending results, further ones are dropped. Default is 1000.')
+    parser.add_argument('-j', '--jitter', action='store', dest='jitter', type=float, default=0.1,
+        help='Random shift of each run, as a fraction of the check interval. Default is 0.1.')
+    parser.add_argument('-t', '--timeout', action='store', dest='timeout', type=int, default=60,
+        help='Seconds a check may run before it is killed and reported UNKNOWN. Default is 60.')
+    parser.add_argument('--stats-interval', action='store', dest='stats_interval', type=float, default=60,
+        help='Seconds between results of the check_scheduler service with run and drop counters, 0 disables them. Default is 60.')
+    parser.add_argument('--version', action='version', version='%(prog)s 0.1.0')
+
+    arguments = parser.parse_args(argv)
+
+    if bool(arguments.spool) == bool(arguments.pipe):
+        print 'ERROR: one of --spool or --pipe is required.'
+        exit(UNKNOWN)
+
+    if arguments.workers < 1 or arguments.queue_size < 1 or arguments.timeout < 1 or not 0 <= arguments.jitter < 1:
+        print 'ERROR: workers, queue size and timeout must be at least 1, jitter between 0 and 1.'
+        exit(UNKNOWN)
+
+    try:
+        checks = read_checks(arguments.file)
+    except (IOError, ValueError) as e:
+        print 'ERROR: %s' % e
+        exit(UNKNOWN)
+
+    if not checks:
+        print 'ERROR: no checks given.'
+        exit(UNKNOWN)
+
+    if arguments.spool:
+        writer = Spool(arguments.spool, arguments.max_bytes, arguments.backups)
+    else:
+        writer = Pipe(arguments.pipe)
+
+    plugins = load_plugins(set(plugin for interval, service, plugin, check_argv in checks if plugin in PLUGINS))
+    scheduler = Scheduler(checks, plugins, writer, arguments.hostname, arguments.workers,
+        arguments.queue_size, arguments.jitter, arguments.stats_interval, arguments.timeout)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+    exit(OK)
+
+
+
+if __name__ == '__main__':
+    main()
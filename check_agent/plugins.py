@@ -0,0 +1,220 @@
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Loads the check plugins of this repository as modules, so long running
+processes run their main() without starting an interpreter per check.
+"""
+
+import errno
+import imp
+import marshal
+import os
+import select
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from cStringIO import StringIO
+
+
+OK = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGINS = ('check_cpu', 'check_disk', 'check_load', 'check_mem', 'check_netstat', 'check_network', 'check_swap')
+
+
+
+def load_plugins(names=PLUGINS):
+    ''' Imports each plugin from <name>/<name>.py, returns a dict of name: module. '''
+    plugins = {}
+
+    for name in names:
+        plugins[name] = imp.load_source(name, os.path.join(ROOT, name, name + '.py'))
+
+    return plugins
+
+
+def exit_status(code):
+    ''' Exit status of a SystemExit code, as the interpreter would report it. '''
+    if code is None:
+        return OK
+
+    if isinstance(code, (int, long)):
+        return code
+
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+class ThreadStream(object):
+    ''' Stands for sys.stdout or sys.stderr, writing to the buffer of the current thread when it has one. '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, data):
+        self.target().write(data)
+
+    def writelines(self, lines):
+        self.target().writelines(lines)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_STREAMS_LOCK = threading.Lock()
+
+
+def thread_streams():
+    ''' Replaces sys.stdout and sys.stderr by ThreadStream proxies, once. '''
+    with _STREAMS_LOCK:
+        if not isinstance(sys.stdout, ThreadStream):
+            sys.stdout = ThreadStream(sys.stdout)
+        if not isinstance(sys.stderr, ThreadStream):
+            sys.stderr = ThreadStream(sys.stderr)
+
+    return sys.stdout, sys.stderr
+
+
+def run_plugin(plugin, argv):
+    '''
+    Runs main() of a plugin module with argv as its command line. Returns the
+    exit status, standard output and standard error the script would give. An
+    uncaught exception is UNKNOWN, with its traceback on standard error. Safe
+    to call from several threads at once.
+    '''
+    stdout, stderr = thread_streams()
+    stdout.local.buffer, stderr.local.buffer = StringIO(), StringIO()
+
+    try:
+        try:
+            plugin.main(argv)
+            status = OK
+        except SystemExit as e:
+            status = exit_status(e.code)
+        except Exception:
+            traceback.print_exc()
+            status = UNKNOWN
+
+        return status, stdout.local.buffer.getvalue(), stderr.local.buffer.getvalue()
+    finally:
+        stdout.local.buffer = stderr.local.buffer = None
+
+
+_FORK_LOCK = threading.Lock()
+
+
+def run_forked(plugin, argv, timeout, children=None):
+    '''
+    Runs a plugin as run_plugin() does, in a forked child. The globals of the
+    module are the ones loaded at start up on every run, and a hung check (ie:
+    statvfs of a dead NFS mount) is killed after timeout seconds. Returns the
+    status, standard output and standard error, None when the check was killed.
+    The pid of the child is in the set children while it runs. Safe to call
+    from several threads at once.
+    '''
+    with _FORK_LOCK:                                    # children of other threads must not inherit write_fd.
+        thread_streams()                                # not taken by a thread at fork time, the child needs it.
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                data = marshal.dumps(run_plugin(plugin, argv))
+                while data:
+                    data = data[os.write(write_fd, data):]
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+
+    if children is not None:
+        children.add(pid)
+
+    deadline = time.time() + timeout
+    data = ''
+
+    try:
+        while True:
+            wait = deadline - time.time()
+
+            try:
+                ready = wait > 0 and select.select([read_fd], [], [], wait)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not ready:
+                os.kill(pid, signal.SIGKILL)
+                return None
+
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        if children is not None:
+            children.discard(pid)
+
+    try:
+        return marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return UNKNOWN, 'ERROR: check exited without a result.\n', ''
+
+
+class Pipe(object):
+    '''
+    Writes to a named pipe, ie: the Icinga/Nagios command file. Fails while
+    nobody reads it. Writes are split on line boundaries in chunks of at most
+    PIPE_BUF bytes, which the kernel keeps whole, so lines of other writers to
+    the same pipe are never interleaved with ours.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def chunks(self, data):
+        ''' Whole lines up to PIPE_BUF bytes per chunk, a longer line is a chunk of its own. '''
+        chunk = ''
+
+        for line in data.splitlines(True):
+            if chunk and len(chunk) + len(line) > select.PIPE_BUF:
+                yield chunk
+                chunk = ''
+            chunk += line
+
+        if chunk:
+            yield chunk
+
+    def write(self, data):
+        fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)    # ENXIO without a reader.
+        try:
+            for chunk in self.chunks(data):
+                while chunk:
+                    try:
+                        chunk = chunk[os.write(fd, chunk):]
+                    except OSError as e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                        time.sleep(0.05)                # reader is behind.
+        finally:
+            os.close(fd)
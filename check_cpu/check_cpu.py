@@ -7,18 +7,34 @@ http://github.com/viniciusfs/check_plugins
 
 import re
 import argparse
-
-from collections import defaultdict
+import math
+import errno
+import fcntl
+import json
+import os
+import stat
+import tempfile
+
+from array import array
+from collections import defaultdict, deque
 from copy import deepcopy
 from sys import exit
 from time import sleep
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 OK = 0
 WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+CPU_FIELDS = ('user', 'nice', 'sys', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+STATE_MIN_AGE = 1                                       # seconds, younger snapshots are too coarse to diff.
+
 
 def read_procfs():
     try:
@@ -30,9 +46,10 @@ def read_procfs():
         exit(UNKNOWN)
 
 
-def cpu_status():
+def cpu_status(output=None):
     regex = re.compile(r'cpu  (?P<user>\d+)\s(?P<nice>\d+)\s(?P<sys>\d+)\s(?P<idle>\d+)\s(?P<iowait>\d+)\s(?P<irq>\d+)\s(?P<softirq>\d+)\s(?P<steal>\d+)')
-    output = read_procfs()
+    if output is None:
+        output = read_procfs()
     match = regex.search(output.split('\n')[0])
 
     if match:
@@ -48,6 +65,60 @@ def cpu_status():
         return False
 
 
+def cores_status(output=None):
+    '''
+    Parses every cpuN line of /proc/stat in one pass. Returns the core numbers
+    and, in compact arrays, the busy (same fields as perc_inuse) and total time
+    of each core.
+    '''
+    if output is None:
+        output = read_procfs()
+
+    cores = array('i')
+    busy = array('d')
+    total = array('d')
+
+    for line in output.split('\n')[1:]:
+        if not line.startswith('cpu'):
+            break
+
+        fields = line.split()
+        values = [float(x) for x in fields[1:9]]        # user nice sys idle iowait irq softirq steal
+
+        cores.append(int(fields[0][3:]))
+        busy.append(sum(values) - values[3])
+        total.append(sum(values))
+
+    return cores, busy, total
+
+
+def calc_cores_percentage(first, second):
+    '''
+    Usage in percentage of every core between two cores_status() samples,
+    computed in batch (with NumPy when available). Returns (core, usage) pairs.
+    '''
+    cores, busy1, total1 = first
+    cores2, busy2, total2 = second
+
+    if cores != cores2:                                 # a core went on or offline, compare the common ones.
+        index = dict((core, i) for i, core in enumerate(cores2))
+        common = [i for i, core in enumerate(cores) if core in index]
+        busy2 = array('d', [busy2[index[cores[i]]] for i in common])
+        total2 = array('d', [total2[index[cores[i]]] for i in common])
+        busy1 = array('d', [busy1[i] for i in common])
+        total1 = array('d', [total1[i] for i in common])
+        cores = array('i', [cores[i] for i in common])
+
+    if numpy is not None and len(cores):
+        busy = numpy.frombuffer(busy2) - numpy.frombuffer(busy1)
+        total = numpy.frombuffer(total2) - numpy.frombuffer(total1)
+        usage = (100 * busy / numpy.maximum(total, 1)).tolist()
+    else:
+        usage = [100 * (b2 - b1) / max(t2 - t1, 1) for b1, b2, t1, t2 in zip(busy1, busy2, total1, total2)]
+
+    return zip(cores, usage)
+
+
 def diff_checks(first, second):
     diff = deepcopy(second)
 
@@ -80,6 +151,209 @@ def check_cpu(interval):
         return False
 
 
+def _read_cpu_values(fd):
+    ''' The aggregate cpu line of an open /proc/stat as floats, with a single read and no regex. '''
+    os.lseek(fd, 0, os.SEEK_SET)
+    data = os.read(fd, 4096)
+    return [float(x) for x in data[:data.index('\n')].split()[1:9]]
+
+
+def _values_status(values):
+    ''' Same dict as cpu_status() from the values of _read_cpu_values(). '''
+    status = dict(zip(CPU_FIELDS, values))
+    status['total'] = sum(values)
+    status['perc_inuse'] = status['total'] - status['idle']
+    return status
+
+
+def check_cpu_samples(interval, samples, warning):
+    '''
+    Reads /proc/stat samples + 1 times evenly spread over interval and keeps the
+    usage of every sub-interval in a fixed size ring buffer. Adds the mean, max
+    and 95th percentile of the samples, and how many are above warning, to the
+    usual results.
+    '''
+    usages = deque(maxlen=samples)
+
+    try:
+        fd = os.open('/proc/stat', os.O_RDONLY)
+    except OSError as e:
+        print 'ERROR: %s' % e
+        exit(UNKNOWN)
+
+    try:
+        first = previous = _read_cpu_values(fd)
+        start = monotonic()
+
+        for i in range(1, samples + 1):
+            delay = start + interval * i / float(samples) - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            current = _read_cpu_values(fd)
+            total = sum(current) - sum(previous)
+            busy = total - (current[3] - previous[3])
+            usages.append(100 * busy / total if total > 0 else 0.0)
+            previous = current
+    finally:
+        os.close(fd)
+
+    diff = diff_checks(_values_status(first), _values_status(current))
+    if diff['total'] <= 0:
+        return False
+
+    cpu_usage = calc_percentage(diff)
+    ordered = sorted(usages)
+
+    cpu_usage['usage_mean'] = cpu_usage['perc_inuse']   # weighted by the time of each sample.
+    cpu_usage['usage_max'] = ordered[-1]
+    cpu_usage['usage_p95'] = ordered[int(math.ceil(0.95 * len(ordered))) - 1]
+    cpu_usage['samples_above'] = len([usage for usage in ordered if usage > warning])
+
+    return cpu_usage
+
+
+def check_cpu_cores(interval, warning, critical, top_cores):
+    '''
+    Aggregate and per-core CPU usage, both from the same two reads of /proc/stat.
+    Adds the hottest core usage, the number of cores above each threshold and
+    the top_cores hottest cores to the aggregate results. Returns the results
+    and every (core, usage) pair, hottest first.
+    '''
+    first_output = read_procfs()
+    sleep(interval)
+    second_output = read_procfs()
+
+    first_check = cpu_status(first_output)
+    second_check = cpu_status(second_output)
+
+    if not (first_check and second_check):
+        return False, []
+
+    cpu_usage = calc_percentage(diff_checks(first_check, second_check))
+    cores_usage = calc_cores_percentage(cores_status(first_output), cores_status(second_output))
+    cores_usage.sort(key=lambda core: core[1], reverse=True)
+
+    cpu_usage['core_max'] = cores_usage[0][1] if cores_usage else 0.0
+    cpu_usage['cores_warning'] = len([core for core in cores_usage if core[1] > warning])
+    cpu_usage['cores_critical'] = len([core for core in cores_usage if core[1] >= critical])
+
+    for core, usage in cores_usage[:top_cores]:
+        cpu_usage['cpu%d' % core] = usage
+
+    return cpu_usage, cores_usage
+
+
+def monotonic():
+    ''' Seconds elapsed since an arbitrary point in the past, not affected by wall clock changes. '''
+    return os.times()[4]
+
+
+def default_state_file():
+    return os.path.join(tempfile.gettempdir(), 'check_cpu.%d.state' % os.getuid())
+
+
+def _open_private(path, flags):
+    '''
+    Opens path only if it is a regular file of ours that nobody else can write,
+    the default state file lives in the shared temporary directory. Raises
+    OSError otherwise.
+    '''
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0600)
+    info = os.fstat(fd)
+
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 022:
+        os.close(fd)
+        raise OSError(errno.EPERM, 'untrusted state file', path)
+
+    return fd
+
+
+def load_state(state_file):
+    ''' State saved by a previous run, None when missing, untrusted or not {"timestamp": number, "status": dict}. '''
+    try:
+        with os.fdopen(_open_private(state_file, os.O_RDONLY), 'r') as data_file:
+            state = json.load(data_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(state, dict) or not isinstance(state.get('status'), dict):
+        return None
+
+    if isinstance(state.get('timestamp'), bool) or not isinstance(state.get('timestamp'), (int, long, float)):
+        return None
+
+    return state
+
+
+def lock_state(state_file):
+    ''' Exclusive lock on state_file + .lock, held until the returned file is closed. Exits UNKNOWN when not possible. '''
+    try:
+        lock_file = os.fdopen(_open_private(state_file + '.lock', os.O_WRONLY | os.O_CREAT), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+        print 'ERROR: Fail while locking CPU state: %s' % e
+        exit(UNKNOWN)
+
+    return lock_file
+
+
+def save_state(state_file, state):
+    ''' Write state to a temporary file renamed over state_file, so readers never see a partial write. '''
+    fd, temp_file = tempfile.mkstemp(prefix='.check_cpu.', dir=os.path.dirname(os.path.abspath(state_file)))
+    try:
+        with os.fdopen(fd, 'w') as data_file:
+            json.dump(state, data_file)
+        os.rename(temp_file, state_file)
+    except (IOError, OSError):
+        os.unlink(temp_file)
+        raise
+
+
+def check_cpu_stateful(interval, state_file, max_age):
+    '''
+    CPU usage since the snapshot stored by the previous run, without sleeping.
+    Falls back to a short sleep on the first run or when the snapshot is older
+    than max_age seconds (or from before a reboot). A lock on state_file + .lock
+    serializes concurrent runs.
+    '''
+    with lock_state(state_file):
+        previous = load_state(state_file)
+        second_check = cpu_status()
+        timestamp = monotonic()
+
+        if not second_check:
+            return False
+
+        first_check = None
+        if previous and STATE_MIN_AGE <= timestamp - previous['timestamp'] <= max_age:
+            first_check = previous['status']
+            if set(first_check) != set(second_check) or not all(isinstance(v, (int, long, float)) for v in first_check.itervalues()):
+                first_check = None                      # not a snapshot of this plugin.
+            elif diff_checks(first_check, second_check)['total'] <= 0:
+                first_check = None
+
+        if first_check is None:
+            first_check = second_check
+            sleep(min(interval, STATE_MIN_AGE))
+            second_check = cpu_status()
+            timestamp = monotonic()
+
+            if not second_check:
+                return False
+
+        try:
+            save_state(state_file, {'timestamp': timestamp, 'status': second_check})
+        except (IOError, OSError) as e:
+            print 'ERROR: Fail while saving CPU state: %s' % e
+            exit(UNKNOWN)
+
+    diff = diff_checks(first_check, second_check)
+    cpu_usage = calc_percentage(diff)
+
+    return cpu_usage
+
+
 def print_perfdata(results):
     output = ''
 
@@ -89,7 +363,7 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="""Icinga plugin to check
     the amount of used CPU on Linux systems. It will generate an alert if
     CPU utilization (in percentage) is greater than your thresholds.
@@ -101,16 +375,40 @@ def main():
         help='Critical threshold. Returns critical if percentage of CPU usage is greater than this value. Default is 90.')
     parser.add_argument('-i', '--interval', action='store', dest='interval', type=int, default=5,
         help='Time delay in seconds between CPU info collects. Default is 5.')
+    parser.add_argument('-s', '--stateful', action='store_true', dest='stateful',
+        help='Report usage since the previous run, kept in a state file, instead of sleeping. The first run, or a run after a stale snapshot, sleeps 1 second.')
+    parser.add_argument('--state-file', action='store', dest='state_file', type=str, default=default_state_file(),
+        help='State file used by --stateful. Default is check_cpu.<uid>.state in the temporary directory.')
+    parser.add_argument('--max-age', action='store', dest='max_age', type=int, default=900,
+        help='Seconds after which a --stateful snapshot is too old to be used. Default is 900.')
+    parser.add_argument('--per-core', action='store_true', dest='per_core',
+        help='Test thresholds against each core instead of the aggregate: alerts when --min-cores cores are above a threshold.')
+    parser.add_argument('--min-cores', action='store', dest='min_cores', type=int, default=1,
+        help='Number of cores above a threshold needed to alert with --per-core. Default is 1, the hottest core.')
+    parser.add_argument('--top-cores', action='store', dest='top_cores', type=int, default=4,
+        help='Number of hottest cores included in performance data with --per-core. Default is 4.')
+    parser.add_argument('--samples', action='store', dest='samples', type=int, default=1,
+        help='Number of sub-samples taken inside the interval, to catch bursts shorter than it. Default is 1.')
+    parser.add_argument('--statistic', action='store', dest='statistic', choices=['mean', 'max', 'p95'], default='mean',
+        help='Statistic of the sub-samples tested against thresholds when --samples is greater than 1. Default is mean.')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
         help='No alert, only check CPU and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.2.1')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     warning = arguments.warning_threshold
     critical = arguments.critical_threshold
     interval = arguments.interval
     noalert = arguments.noalert
+    stateful = arguments.stateful
+    state_file = arguments.state_file
+    max_age = arguments.max_age
+    per_core = arguments.per_core
+    min_cores = arguments.min_cores
+    top_cores = arguments.top_cores
+    samples = arguments.samples
+    statistic = arguments.statistic
 
     if warning > critical:
         print 'ERROR: warning threshold greater than critical threshold.'
@@ -120,19 +418,56 @@ def main():
         print 'ERROR: warning and critical threshold are equal.'
         exit(UNKNOWN)
 
-    cpu_usage = check_cpu(interval)
+    if per_core and stateful:
+        print 'ERROR: --per-core and --stateful can not be used together.'
+        exit(UNKNOWN)
+
+    if samples > 1 and (per_core or stateful):
+        print 'ERROR: --samples can not be used with --per-core or --stateful.'
+        exit(UNKNOWN)
+
+    if samples < 1:
+        print 'ERROR: --samples must be at least 1.'
+        exit(UNKNOWN)
+
+    if min_cores < 1:
+        print 'ERROR: --min-cores must be at least 1.'
+        exit(UNKNOWN)
+
+    if per_core:
+        cpu_usage, cores_usage = check_cpu_cores(interval, warning, critical, top_cores)
+    elif stateful:
+        cpu_usage = check_cpu_stateful(interval, state_file, max_age)
+    elif samples > 1:
+        cpu_usage = check_cpu_samples(interval, samples, warning)
+    else:
+        cpu_usage = check_cpu(interval)
 
     if cpu_usage:
-        if cpu_usage['perc_inuse'] <= warning or noalert:
-            print 'CPU %s %.2f%% in use | %s' % ('OK', cpu_usage['perc_inuse'], print_perfdata(cpu_usage))
+        usage = cpu_usage['perc_inuse']
+        message = '%.2f%% in use' % usage
+
+        if samples > 1 and statistic != 'mean':
+            usage = cpu_usage['usage_' + statistic]
+            message += ', %s %.2f%%' % (statistic, usage)
+
+        if per_core:
+            # The min_cores-th hottest core is above a threshold when at least
+            # min_cores cores are.
+            usage = cores_usage[min_cores - 1][1] if len(cores_usage) >= min_cores else 0.0
+            message += ', hottest core cpu%d %.2f%%, %d core(s) above warning' % (
+                cores_usage[0][0], cores_usage[0][1], cpu_usage['cores_warning']) if cores_usage else ''
+
+        if usage <= warning or noalert:
+            print 'CPU %s %s | %s' % ('OK', message, print_perfdata(cpu_usage))
             exit(OK)
 
-        if cpu_usage['perc_inuse'] > warning and cpu_usage['perc_inuse'] < critical:
-            print 'CPU %s %.2f%% in use | %s' % ('WARNING', cpu_usage['perc_inuse'], print_perfdata(cpu_usage))
+        if usage > warning and usage < critical:
+            print 'CPU %s %s | %s' % ('WARNING', message, print_perfdata(cpu_usage))
             exit(WARNING)
 
-        if cpu_usage['perc_inuse'] >= critical:
-            print 'CPU %s %.2f%% in use | %s' % ('CRITICAL', cpu_usage['perc_inuse'], print_perfdata(cpu_usage))
+        if usage >= critical:
+            print 'CPU %s %s | %s' % ('CRITICAL', message, print_perfdata(cpu_usage))
             exit(CRITICAL)
     else:
         print 'ERROR: Fail while reading CPU information.'
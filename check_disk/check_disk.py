@@ -6,7 +6,17 @@ http://github.com/viniciusfs/check_plugins
 """
 
 import argparse
+import errno
+import fcntl
+import hashlib
+import marshal
 import os
+import Queue
+import stat
+import struct
+import tempfile
+import threading
+import time
 
 from sys import exit
 
@@ -16,11 +26,22 @@ WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+EXCLUDE_FSTYPES = frozenset([ 'sysfs', 'proc', 'devtmpfs', 'devpts', 'tmpfs',
+    'securityfs', 'cgroup', 'efivarfs', 'autofs', 'debugfs', 'mqueue',
+    'hugetlbfs', 'fusectl', 'rpc_pipefs', 'nfsd', 'binfmt_misc',
+    'fuse.gvfsd-fuse', 'pstore' ])
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+HISTORY_HEADER = struct.Struct('=II')                   # capacity, number of samples.
+HISTORY_SAMPLE = struct.Struct('=dd')                   # wall clock time, used kB.
+
+CACHE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()    # tmpfs, see _cached().
+_CACHE_STATS = {'cache_hits': 0, 'cache_misses': 0}
 
 
 def read_procfs():
     try:
-        with open('/proc/mounts', 'r') as data_file:
+        with open('/proc/self/mountinfo', 'r') as data_file:
             contents = data_file.read()
 
             return contents
@@ -38,47 +59,435 @@ def disk_status(mount_point):
         print 'ERROR: Error while getting disk information.'
         exit(UNKNOWN)
 
+    return statvfs_status(stat)
+
+
+def statvfs_status(stat):
     total = float((stat.f_blocks * stat.f_frsize) / 1024)
     used = float(((stat.f_blocks - stat.f_bfree) * stat.f_frsize) / 1024)
     free = float((stat.f_bavail * stat.f_frsize) / 1024)
     perc_inuse = 100 - (free / total) * 100
 
+    inodes_total = float(stat.f_files)
+    inodes_used = float(stat.f_files - stat.f_ffree)
+    inodes_perc_inuse = (inodes_used / inodes_total) * 100 if inodes_total else 0.0    # ie: btrfs has no inode limit.
+
     status = {
         'total': total,
         'used': used,
         'free': free,
-        'perc_inuse': perc_inuse
+        'perc_inuse': perc_inuse,
+        'inodes_total': inodes_total,
+        'inodes_used': inodes_used,
+        'inodes_perc_inuse': inodes_perc_inuse
     }
 
     return status
 
 
-def valid_mount_point(mount_point):
-    valid_mounts = []
-    exclude_fstypes = [ 'sysfs', 'proc', 'devtmpfs', 'devpts', 'tmpfs',
-        'securityfs', 'cgroup', 'efivarfs', 'autofs', 'debugfs', 'mqueue',
-        'hugetlbfs', 'fusectl', 'rpc_pipefs', 'nfsd', 'binfmt_misc',
-        'fuse.gvfsd-fuse', 'pstore' ]
-    output = read_procfs()
+def mount_table():
+    '''
+    Parses /proc/self/mountinfo once into two indexes: mount point -> mount
+    (device id, root of the mount inside the file system, fstype), and device id
+    (major:minor) -> list of its mount points. Bind mounts of one file system
+    share the same device id.
+    '''
+    mounts = {}
+    devices = {}
+
+    for line in read_procfs().splitlines():
+        fields = line.split()
+        separator = fields.index('-', 6)                # optional fields end with a single -.
+        mount_point = fields[4]
+
+        if '\\' in mount_point:                        # spaces and such are octal escaped.
+            mount_point = mount_point.decode('string_escape')
 
-    for line in output[:-1].split('\n'):
-        device, mount, fstype = line.split()[0], line.split()[1], line.split()[2]
+        mounts[mount_point] = {'device': fields[2], 'root': fields[3], 'fstype': fields[separator + 1]}
+        devices.setdefault(fields[2], []).append(mount_point)
 
-        if fstype not in exclude_fstypes:
-            valid_mounts.append(mount)
+    return mounts, devices
 
-    if mount_point in valid_mounts:
+
+def valid_mount_point(mount_point, table=None):
+    mounts, devices = table or mount_table()
+
+    if mount_point in mounts and mounts[mount_point]['fstype'] not in EXCLUDE_FSTYPES:
         return True
     else:
         return False
 
 
+def valid_mount_points(table=None):
+    mounts, devices = table or mount_table()
+
+    return [mount for mount in mounts if mounts[mount]['fstype'] not in EXCLUDE_FSTYPES]
+
+
+def unique_file_systems(table=None):
+    '''
+    One valid mount point per file system (device id), so bind mounts of the same
+    file system are measured once. The mount of the file system root is preferred,
+    then the shortest mount point.
+    '''
+    mounts, devices = table or mount_table()
+    file_systems = []
+
+    for device, mount_points in devices.iteritems():
+        valid = [mount for mount in mount_points
+                 if mounts.get(mount, {}).get('device') == device and mounts[mount]['fstype'] not in EXCLUDE_FSTYPES]
+
+        if valid:
+            file_systems.append(min(valid, key=lambda mount: (mounts[mount]['root'] != '/', len(mount), mount)))
+
+    return file_systems
+
+
+def mount_namespace():
+    ''' Cache key of the mount table, which differs between mount namespaces (ie: containers). '''
+    try:
+        return 'proc_self_mountinfo.%s' % os.stat('/proc/self/ns/mnt').st_ino
+    except OSError:
+        return 'proc_self_mountinfo'
+
+
 def check_disk(mount_point):
     disk_usage = disk_status(mount_point)
 
     return disk_usage
 
 
+def monotonic():
+    ''' Seconds elapsed since an arbitrary point in the past, not affected by wall clock changes. '''
+    return os.times()[4]
+
+
+def statvfs_pool(mount_points, workers, timeout):
+    '''
+    os.statvfs() of every mount point, run by a bounded pool of daemon threads.
+    A mount point not answering within timeout seconds (ie: hung NFS server) is
+    given up and its thread replaced, so the other mount points are not held
+    back. Returns a dict of mount point: statvfs result, OSError, or None when
+    timed out.
+    '''
+    pending = Queue.Queue()
+    done = Queue.Queue()
+    started = {}
+    lock = threading.Lock()
+
+    for mount_point in mount_points:
+        pending.put(mount_point)
+
+    def worker():
+        while True:
+            try:
+                mount_point = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            with lock:
+                started[mount_point] = monotonic()
+
+            try:
+                done.put((mount_point, os.statvfs(mount_point)))
+            except OSError as e:
+                done.put((mount_point, e))
+
+    def spawn():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True                            # a thread stuck in statvfs must not block exit.
+        thread.start()
+
+    for i in range(min(workers, len(mount_points))):
+        spawn()
+
+    results = {}
+
+    while len(results) < len(mount_points):
+        try:
+            mount_point, result = done.get(timeout=0.05)
+            results.setdefault(mount_point, result)
+        except Queue.Empty:
+            pass
+
+        now = monotonic()
+        with lock:
+            for mount_point, start in started.items():
+                if mount_point not in results and now - start > timeout:
+                    results[mount_point] = None
+                    spawn()
+
+    return results
+
+
+def check_all_disks(workers, timeout, table=None):
+    '''
+    Usage of every real file system. Returns a dict of mount point: usage dict,
+    or an error message when statvfs failed or timed out.
+    '''
+    mount_points = unique_file_systems(table)
+    disk_usage = {}
+
+    for mount_point, stat in statvfs_pool(mount_points, workers, timeout).iteritems():
+        if stat is None:
+            disk_usage[mount_point] = 'timed out'
+        elif isinstance(stat, OSError):
+            disk_usage[mount_point] = stat.strerror
+        elif stat.f_blocks == 0:                        # nothing to measure, ie: special file systems.
+            continue
+        else:
+            disk_usage[mount_point] = statvfs_status(stat)
+
+    return disk_usage
+
+
+def history_file(state_dir, mount_point):
+    return os.path.join(state_dir, 'check_disk.%d.%s.history' % (os.getuid(), hashlib.md5(mount_point).hexdigest()[:16]))
+
+
+def load_history(path, capacity):
+    ''' Samples of a history file, oldest first. A file made for another capacity is discarded. '''
+    try:
+        with os.fdopen(_open_private(path, os.O_RDONLY), 'rb') as data_file:
+            data = data_file.read()
+        stored_capacity, count = HISTORY_HEADER.unpack_from(data)
+    except (IOError, OSError, struct.error):
+        return []
+
+    if stored_capacity != capacity or len(data) != HISTORY_HEADER.size + capacity * HISTORY_SAMPLE.size:
+        return []
+
+    return [HISTORY_SAMPLE.unpack_from(data, HISTORY_HEADER.size + i * HISTORY_SAMPLE.size) for i in range(min(count, capacity))]
+
+
+def save_history(path, capacity, samples):
+    ''' Write samples to a file of fixed size, through a temporary file renamed over path. '''
+    data = bytearray(HISTORY_HEADER.size + capacity * HISTORY_SAMPLE.size)
+    HISTORY_HEADER.pack_into(data, 0, capacity, len(samples))
+
+    for i, sample in enumerate(samples):
+        HISTORY_SAMPLE.pack_into(data, HISTORY_HEADER.size + i * HISTORY_SAMPLE.size, *sample)
+
+    fd, temp_file = tempfile.mkstemp(prefix='.check_disk.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as data_file:
+            data_file.write(data)
+        os.rename(temp_file, path)
+    except (IOError, OSError):
+        os.unlink(temp_file)
+        raise
+
+
+def growth_rate(samples):
+    ''' Slope in kB/s of the least squares line through (time, used) samples, None with too few samples. '''
+    if len(samples) < 2:
+        return None
+
+    mean_time = sum(sample[0] for sample in samples) / len(samples)
+    mean_used = sum(sample[1] for sample in samples) / len(samples)
+    variance = sum((sample[0] - mean_time) ** 2 for sample in samples)
+
+    if variance == 0:
+        return None
+
+    return sum((sample[0] - mean_time) * (sample[1] - mean_used) for sample in samples) / variance
+
+
+def forecast_disk(mount_point, disk_usage, state_dir, capacity):
+    '''
+    Adds the current used space to the history of mount_point, keeping the last
+    capacity samples, and adds the growth rate in bytes/s and, when growing, the
+    estimated seconds until the file system is full to disk_usage. Raises
+    IOError or OSError when the history can not be locked or saved.
+    '''
+    path = history_file(state_dir, mount_point)
+
+    with os.fdopen(_open_private(path + '.lock', os.O_WRONLY | os.O_CREAT), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        samples = load_history(path, capacity)
+        now = time.time()
+
+        if samples and now < samples[-1][0]:           # clock went back, start over.
+            samples = []
+
+        if not samples or now - samples[-1][0] >= 1:
+            samples = (samples + [(now, disk_usage['used'])])[-capacity:]
+            save_history(path, capacity, samples)
+
+    growth = growth_rate(samples)
+
+    if growth is not None:
+        disk_usage['growth'] = growth * 1024
+
+        if growth > 0:
+            disk_usage['time_to_full'] = disk_usage['free'] / growth
+
+    return disk_usage
+
+
+def disk_state(disk_usage, warning, critical, ttf_warning=None, ttf_critical=None):
+    '''
+    State of a file system: the worse of its space and inode usage against the
+    thresholds, and of its time to full against the time to full thresholds.
+    '''
+    perc_inuse = max(disk_usage['perc_inuse'], disk_usage['inodes_perc_inuse'])
+    time_to_full = disk_usage.get('time_to_full')
+
+    def full_within(threshold):
+        return threshold is not None and time_to_full is not None and time_to_full < threshold
+
+    if perc_inuse >= critical or full_within(ttf_critical):
+        return CRITICAL
+
+    if perc_inuse > warning or full_within(ttf_warning):
+        return WARNING
+
+    return OK
+
+
+def describe_disk(disk_usage):
+    output = '%.2f%% in use, %.2f%% inodes in use' % (disk_usage['perc_inuse'], disk_usage['inodes_perc_inuse'])
+
+    if 'time_to_full' in disk_usage:
+        output += ', full in %.1f hours' % (disk_usage['time_to_full'] / 3600)
+
+    return output
+
+
+def print_all_disks(disk_usage, warning, critical, noalert, ttf_warning=None, ttf_critical=None, cache_stats=None):
+    ''' Prints the result of check_all_disks() and exits with the worst state found. '''
+    severity = [OK, UNKNOWN, WARNING, CRITICAL]
+    status = OK
+    details = ''
+    perfdata = ''
+
+    for mount_point in sorted(disk_usage):
+        usage = disk_usage[mount_point]
+
+        if not isinstance(usage, dict):
+            mount_status = UNKNOWN
+            details += ', %s %s' % (mount_point, usage)
+        else:
+            mount_status = disk_state(usage, warning, critical, ttf_warning, ttf_critical)
+
+            if mount_status != OK:
+                details += ', %s %s' % (mount_point, describe_disk(usage))
+
+            for k, v in usage.iteritems():
+                perfdata += '\'%s_%s\'=%.2f ' % (mount_point, k, v)
+
+        if severity.index(mount_status) > severity.index(status):
+            status = mount_status
+
+    if cache_stats:
+        perfdata += print_perfdata(cache_stats)
+
+    if noalert:
+        status = OK
+
+    print 'File systems %s %d checked%s | %s' % (STATE_NAMES[status], len(disk_usage), details, perfdata)
+    exit(status)
+
+
+def _open_private(path, flags):
+    '''
+    Opens a file of a directory where anyone may create files, ie: CACHE_DIR or
+    the default --state-dir, only if it is a regular file of ours that nobody
+    else can write. Raises OSError otherwise.
+    '''
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0600)
+    info = os.fstat(fd)
+
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 022:
+        os.close(fd)
+        raise OSError(errno.EPERM, 'untrusted file', path)
+
+    return fd
+
+
+def _read_cache(path, ttl):
+    try:
+        fd = _open_private(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        with os.fdopen(fd, 'rb') as data_file:
+            if time.time() - os.fstat(fd).st_mtime < ttl:
+                return marshal.load(data_file)
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        pass
+
+    return None
+
+
+def _write_cache(path, value):
+    try:
+        fd, temp_file = tempfile.mkstemp(prefix='.check_plugins.', dir=CACHE_DIR)
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as data_file:
+            marshal.dump(value, data_file)
+        os.rename(temp_file, path)
+    except (IOError, OSError, ValueError):
+        os.unlink(temp_file)
+
+
+def _lock_cache(path):
+    ''' Locked file descriptor of path, None when it can not be opened or locked. '''
+    try:
+        fd = _open_private(path, os.O_WRONLY | os.O_CREAT)
+    except OSError:
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except IOError:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _cached(key, ttl, load):
+    '''
+    Result of load(), shared with other runs for ttl seconds through a file in
+    CACHE_DIR, so checks started together parse their source once. Runs finding
+    the cache stale wait on a lock for the one loading it. Cache files not owned
+    by us or writable by others are ignored, load() is used whenever the cache
+    can not be. ttl 0 disables it.
+    '''
+    if not ttl:
+        return load()
+
+    path = os.path.join(CACHE_DIR, 'check_plugins.%d.%s.cache' % (os.getuid(), key))
+    value = _read_cache(path, ttl)
+
+    if value is None:
+        lock_fd = _lock_cache(path + '.lock')
+
+        if lock_fd is None:
+            _CACHE_STATS['cache_misses'] += 1
+            return load()
+
+        try:
+            value = _read_cache(path, ttl)              # loaded by another run meanwhile.
+
+            if value is None:
+                _CACHE_STATS['cache_misses'] += 1
+                value = load()
+                _write_cache(path, value)
+                return value
+        finally:
+            os.close(lock_fd)
+
+    _CACHE_STATS['cache_hits'] += 1
+    return value
+
+
 def print_perfdata(results):
     output = ''
 
@@ -88,7 +497,7 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="""Icinga plugin to check
     the amount of used file system space on Linux. It generates an alert if
     percentage of used space is greater then your thresholds. Performance
@@ -100,17 +509,44 @@ def main():
     parser.add_argument('-c', '--critical', action='store', dest='critical_threshold', type=int, default=90,
         help='Critical threshold. Returns critical if percentage of used space is greater than this value. Default is 90.')
     parser.add_argument('-m', '--mount-point', action='store', dest='mount_point',
-        required=True, type=str, help='Mount point to be checked.')
+        type=str, help='Mount point to be checked.')
+    parser.add_argument('-a', '--all', action='store_true', dest='all',
+        help='Check every real file system, bind mounts counted once. Alerts with the worst state found.')
+    parser.add_argument('-t', '--timeout', action='store', dest='timeout', type=float, default=5,
+        help='Seconds to wait for each file system with --all before reporting it UNKNOWN. Default is 5.')
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=4,
+        help='Number of file systems checked at the same time with --all. Default is 4.')
+    parser.add_argument('-f', '--forecast', action='store_true', dest='forecast',
+        help='Keep a history of used space per file system to report its growth rate (bytes/s) and time to full (seconds).')
+    parser.add_argument('--history', action='store', dest='history', type=int, default=30,
+        help='Number of samples kept per file system with --forecast. Default is 30.')
+    parser.add_argument('--state-dir', action='store', dest='state_dir', type=str, default=tempfile.gettempdir(),
+        help='Directory of the --forecast history files. Default is the temporary directory.')
+    parser.add_argument('--ttf-warning', action='store', dest='ttf_warning', type=float,
+        help='Returns warning if the file system is forecast to be full in less than this many seconds. Implies --forecast.')
+    parser.add_argument('--ttf-critical', action='store', dest='ttf_critical', type=float,
+        help='Returns critical if the file system is forecast to be full in less than this many seconds. Implies --forecast.')
+    parser.add_argument('--cache-ttl', action='store', dest='cache_ttl', type=float, default=0,
+        help='Seconds the parsed /proc/self/mountinfo is shared with other runs through a cache in /dev/shm, with cache_hits and cache_misses in performance data. Default is 0, disabled.')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
         help='No alert, only check and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1.1')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     warning = arguments.warning_threshold
     critical = arguments.critical_threshold
     mount_point = arguments.mount_point
     noalert = arguments.noalert
+    check_all = arguments.all
+    timeout = arguments.timeout
+    workers = arguments.workers
+    ttf_warning = arguments.ttf_warning
+    ttf_critical = arguments.ttf_critical
+    forecast = arguments.forecast or ttf_warning is not None or ttf_critical is not None
+    history = arguments.history
+    state_dir = arguments.state_dir
+    cache_ttl = arguments.cache_ttl
 
     if warning > critical:
         print 'ERROR: warning threshold greater than critical threshold.'
@@ -120,23 +556,52 @@ def main():
         print 'ERROR: warning and critical threshold are equal.'
         exit(UNKNOWN)
 
-    if valid_mount_point(mount_point):
+    if history < 2:
+        print 'ERROR: history must keep at least 2 samples.'
+        exit(UNKNOWN)
+
+    table = None
+
+    if cache_ttl:
+        table = _cached(mount_namespace(), cache_ttl, mount_table)
+
+    if check_all:
+        disk_usage = check_all_disks(workers, timeout, table)
+
+        if forecast:
+            for mount_point, usage in disk_usage.iteritems():
+                if isinstance(usage, dict):
+                    try:
+                        forecast_disk(mount_point, usage, state_dir, history)
+                    except (IOError, OSError):
+                        pass                            # no forecast for this one, the others still count.
+
+        print_all_disks(disk_usage, warning, critical, noalert, ttf_warning, ttf_critical, _CACHE_STATS if cache_ttl else None)
+
+    if mount_point is None:
+        print 'ERROR: no mount point given, use --mount-point or --all.'
+        exit(UNKNOWN)
+
+    if valid_mount_point(mount_point, table):
         disk_usage = check_disk(mount_point)
     else:
         print 'ERROR: %s is not a valid mount point.' % mount_point
         exit(UNKNOWN)
 
-    if disk_usage['perc_inuse'] <= warning or noalert:
-        print 'File system %s %s %.2f%% in use | %s' % (mount_point, 'OK', disk_usage['perc_inuse'], print_perfdata(disk_usage))
-        exit(OK)
+    if forecast:
+        try:
+            forecast_disk(mount_point, disk_usage, state_dir, history)
+        except (IOError, OSError) as e:
+            print 'ERROR: Fail while updating forecast history: %s' % e
+            exit(UNKNOWN)
+
+    if cache_ttl:
+        disk_usage.update(_CACHE_STATS)
 
-    if disk_usage['perc_inuse'] > warning and disk_usage['perc_inuse'] < critical:
-        print 'File system %s %s %.2f%% in use | %s' % (mount_point, 'WARNING', disk_usage['perc_inuse'], print_perfdata(disk_usage))
-        exit(WARNING)
+    status = OK if noalert else disk_state(disk_usage, warning, critical, ttf_warning, ttf_critical)
 
-    if disk_usage['perc_inuse'] >= critical:
-        print 'File system %s %s %.2f%% in use | %s' % (mount_point, 'CRITICAL', disk_usage['perc_inuse'], print_perfdata(disk_usage))
-        exit(CRITICAL)
+    print 'File system %s %s %s | %s' % (mount_point, STATE_NAMES[status], describe_disk(disk_usage), print_perfdata(disk_usage))
+    exit(status)
 
 
 
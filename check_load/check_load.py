@@ -6,15 +6,21 @@ http://github.com/viniciusfs/check_plugins
 """
 
 import argparse
+import heapq
 import multiprocessing
+import os
 
 from sys import exit
+from time import sleep
 
 
 OK = 0
 WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
 
 
 
@@ -49,6 +55,99 @@ def check_load():
     return load_usage
 
 
+def monotonic():
+    ''' Seconds elapsed since an arbitrary point in the past, not affected by wall clock changes. '''
+    return os.times()[4]
+
+
+def pid_stat(pid):
+    ''' (command, state, CPU ticks) of a process from one read of /proc/<pid>/stat, None if it is gone. '''
+    try:
+        fd = os.open('/proc/%s/stat' % pid, os.O_RDONLY)
+        try:
+            data = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+
+    # The command may hold spaces and parentheses, the fields follow its last ')'.
+    start = data.find('(')
+    end = data.rfind(')')
+    fields = data[end + 2:].split()
+
+    try:
+        return data[start + 1:end], fields[0], int(fields[11]) + int(fields[12])
+    except (IndexError, ValueError):
+        return None
+
+
+def scan_processes(pids, deadline):
+    ''' pid_stat() of each of pids until deadline, returns the samples and whether the scan was cut short. '''
+    samples = {}
+
+    for pid in pids:
+        if monotonic() > deadline:
+            return samples, True
+
+        sample = pid_stat(pid)
+        if sample:
+            samples[pid] = sample
+
+    return samples, False
+
+
+def top_processes(top, interval, budget):
+    '''
+    Processes using most CPU between two scans of /proc interval seconds apart,
+    and processes in uninterruptible sleep (D state) at the second scan, top of
+    each. Both scans together stop at budget seconds, the second one only looks
+    at pids of the first.
+    '''
+    start = monotonic()
+
+    first, truncated = scan_processes([pid for pid in os.listdir('/proc') if pid.isdigit()],
+        start + max(budget - interval, 0) / 2)
+    first_time = monotonic()
+
+    sleep(interval)
+
+    second_time = monotonic()
+    second, second_truncated = scan_processes(first.keys(), start + budget)
+    elapsed = max(monotonic() - first_time, interval) or 1
+
+    usage = []
+    blocked = []
+
+    for pid, (command, state, ticks) in second.iteritems():
+        perc = 100.0 * (ticks - first[pid][2]) / CLOCK_TICKS / elapsed
+        usage.append((perc, pid, command))
+        if state == 'D':
+            blocked.append((perc, pid, command))
+
+    return {
+        'cpu': heapq.nlargest(top, usage),
+        'blocked': heapq.nlargest(top, blocked),
+        'blocked_count': len(blocked),
+        'scanned': len(second),
+        'truncated': truncated or second_truncated
+    }
+
+
+def print_top(processes):
+    ''' Long output lines of top_processes(). '''
+    lines = 'Top CPU: %s' % ', '.join('%s %s %.2f%%' % (pid, command, perc) for perc, pid, command in processes['cpu'])
+
+    if processes['blocked_count']:
+        lines += '\nD state: %d, %s' % (processes['blocked_count'],
+            ', '.join('%s %s' % (pid, command) for perc, pid, command in processes['blocked']))
+
+    if processes['truncated']:
+        lines += '\nProcess scan stopped by time budget after %d processes.' % processes['scanned']
+
+    return lines
+
+
 def print_perfdata(results):
     output = ''
 
@@ -58,7 +157,7 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="""Icinga plugin to check
     current load average on Linux systems. It will generate an alert if load1
     value is greater than your thresholds.
@@ -70,11 +169,17 @@ def main():
         help='Critical threshold. Returns critical if load1 is greater than this value. Default is 2.')
     parser.add_argument('--cpu-count', action='store_true', dest='cpucount',
         help='Divides load per CPU count before test against thresholds.')
+    parser.add_argument('-t', '--top', action='store', dest='top', type=int, default=0,
+        help='When a threshold is crossed, list the top processes by CPU usage and in D state in long output. Default is 0, disabled.')
+    parser.add_argument('--top-interval', action='store', dest='top_interval', type=float, default=0.5,
+        help='Seconds between the two process scans of --top. Default is 0.5.')
+    parser.add_argument('--top-budget', action='store', dest='top_budget', type=float, default=2,
+        help='Maximum seconds spent by --top, the process scan stops there. Default is 2.')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
         help='No alert, only check and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1.2')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     warning = arguments.warning_threshold
     critical = arguments.critical_threshold
@@ -89,6 +194,10 @@ def main():
         print 'ERROR: warning and critical threshold are equal.'
         exit(UNKNOWN)
 
+    if arguments.top > 0 and not 0 < arguments.top_interval < arguments.top_budget:
+        print 'ERROR: --top-interval must be greater than zero and less than --top-budget.'
+        exit(UNKNOWN)
+
     load_average = check_load()
 
     # FIXME: update all keys in load_average dict when cpucount is true
@@ -99,16 +208,18 @@ def main():
         load = load_average['load1']
 
     if load <= warning or noalert:
-        print 'Load average %s %.2f, %.2f, %.2f | %s' % ('OK', load_average['load1'], load_average['load5'], load_average['load15'], print_perfdata(load_average))
-        exit(OK)
+        status = OK
+    elif load < critical:
+        status = WARNING
+    else:
+        status = CRITICAL
+
+    print 'Load average %s %.2f, %.2f, %.2f | %s' % (STATE_NAMES[status], load_average['load1'], load_average['load5'], load_average['load15'], print_perfdata(load_average))
 
-    if load > warning and load < critical:
-        print 'Load average %s %.2f, %.2f, %.2f | %s' % ('WARNING', load_average['load1'], load_average['load5'], load_average['load15'], print_perfdata(load_average))
-        exit(WARNING)
+    if status != OK and arguments.top > 0:
+        print print_top(top_processes(arguments.top, arguments.top_interval, arguments.top_budget))
 
-    if load >= critical:
-        print 'Load average %s %.2f, %.2f, %.2f | %s' % ('CRITICAL', load_average['load1'], load_average['load5'], load_average['load15'], print_perfdata(load_average))
-        exit(CRITICAL)
+    exit(status)
 
 
 
@@ -6,15 +6,31 @@ http://github.com/viniciusfs/check_plugins
 """
 
 import argparse
-import re
+import errno
+import fcntl
+import json
+import marshal
+import os
+import stat
+import tempfile
+import time
 
 from sys import exit
+from time import sleep
 
 
 OK = 0
 WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+# Counters of the paging rates mode. Reclaim counters are summed per source
+# over the per zone (older kernels) or per memory type fields of /proc/vmstat.
+VMSTAT_COUNTERS = ('pswpin', 'pswpout', 'pgmajfault', 'pgscan_kswapd', 'pgscan_direct', 'pgsteal_kswapd', 'pgsteal_direct')
+STATE_MIN_AGE = 1                                       # seconds, younger snapshots are too coarse to diff.
+CACHE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()    # tmpfs, see _cached().
+_CACHE_STATS = {'cache_hits': 0, 'cache_misses': 0}
 
 
 
@@ -30,37 +46,388 @@ def read_procfs():
         exit(UNKNOWN)
 
 
-def memory_status():
-    regex1 = re.compile(r'MemTotal:\s+(?P<total>\d+)\skB\nMemFree:\s+(?P<free>\d+)\skB\n')
-    regex2 = re.compile(r'Buffers:\s+(?P<buffers>\d+)\skB\nCached:\s+(?P<cached>\d+)\skB\n')
+def meminfo_status(output=None):
+    '''
+    Parses /proc/meminfo into a dict of field name to value in kB, in a single
+    pass that does not depend on the order of the fields. Pass output to parse
+    contents already read.
+    '''
+    if output is None:
+        output = read_procfs()
 
-    output = read_procfs()
+    status = {}
 
-    match1 = regex1.search(output)
-    match2 = regex2.search(output)
+    for line in output.splitlines():
+        fields = line.split()
 
-    if match1 and match2:
-        status = dict((k, float(v)) for k, v in match1.groupdict().iteritems())
+        if len(fields) >= 2 and fields[0].endswith(':'):
+            try:
+                status[fields[0][:-1]] = float(fields[1])
+            except ValueError:
+                pass
 
-        for k, v in match2.groupdict().iteritems():
-            status.update({ k: float(v) })
-        return status
-    else:
+    return status
+
+
+def memory_status(meminfo=None):
+    if meminfo is None:
+        meminfo = meminfo_status()
+
+    try:
+        status = {
+            'total': meminfo['MemTotal'],
+            'free': meminfo['MemFree'],
+            'buffers': meminfo['Buffers'],
+            'cached': meminfo['Cached']
+        }
+    except KeyError:
         return False
 
+    if 'MemAvailable' in meminfo:                       # since Linux 3.14, counts reclaimable slab too.
+        status['available'] = meminfo['MemAvailable']
+
+    return status
+
 
-def check_mem():
-    mem_usage = memory_status()
+def swap_status(meminfo=None):
+    if meminfo is None:
+        meminfo = meminfo_status()
+
+    try:
+        return { 'total': meminfo['SwapTotal'], 'free': meminfo['SwapFree'] }
+    except KeyError:
+        return False
+
+
+def check_mem(meminfo=None):
+    mem_usage = memory_status(meminfo)
 
     if mem_usage:
-        mem_usage['used'] = mem_usage['total'] - (mem_usage['free'] + mem_usage['buffers'] + mem_usage['cached'])
-        mem_usage['perc_inuse'] = 100 - ((mem_usage['free'] + mem_usage['buffers'] + mem_usage['cached']) / mem_usage['total']) * 100
+        available = mem_usage.get('available', mem_usage['free'] + mem_usage['buffers'] + mem_usage['cached'])
+
+        mem_usage['used'] = mem_usage['total'] - available
+        mem_usage['perc_inuse'] = 100 - (available / mem_usage['total']) * 100
 
         return mem_usage
     else:
         return False
 
 
+def check_swap(meminfo=None):
+    swap_usage = swap_status(meminfo)
+
+    if swap_usage:
+        swap_usage['used'] = swap_usage['total'] - swap_usage['free']
+        swap_usage['perc_inuse'] = (swap_usage['used'] / swap_usage['total']) * 100 if swap_usage['total'] else 0.0
+
+        return swap_usage
+    else:
+        return False
+
+
+def usage_state(perc_inuse, warning, critical):
+    if perc_inuse <= warning:
+        return OK
+
+    if perc_inuse < critical:
+        return WARNING
+
+    return CRITICAL
+
+
+def check_mem_swap(warning, critical, swap_warning, swap_critical, noalert, cache_ttl=0):
+    ''' Memory and swap usage from one read of /proc/meminfo, alerting with the worst of both. '''
+    meminfo = _cached('proc_meminfo', cache_ttl, meminfo_status)
+    memory_usage = check_mem(meminfo)
+    swap_usage = check_swap(meminfo)
+
+    if not memory_usage or not swap_usage:
+        print 'ERROR: unexpected /proc/meminfo contents.'
+        exit(UNKNOWN)
+
+    status = max(usage_state(memory_usage['perc_inuse'], warning, critical),
+                 usage_state(swap_usage['perc_inuse'], swap_warning, swap_critical))
+
+    if noalert:
+        status = OK
+
+    perfdata = print_perfdata(memory_usage) + print_perfdata(dict(('swap_%s' % k, v) for k, v in swap_usage.iteritems()))
+
+    if cache_ttl:
+        perfdata += print_perfdata(_CACHE_STATS)
+
+    print 'Memory %s %.2f%% in use, swap %.2f%% in use | %s' % (STATE_NAMES[status], memory_usage['perc_inuse'], swap_usage['perc_inuse'], perfdata)
+    exit(status)
+
+
+def vmstat_counter(name):
+    ''' The counter of VMSTAT_COUNTERS a /proc/vmstat field adds to, or None. '''
+    for counter in VMSTAT_COUNTERS:
+        if name.startswith(counter):
+            if name == counter or (counter.startswith(('pgscan', 'pgsteal')) and name[len(counter)] == '_' and name != 'pgscan_direct_throttle'):
+                return counter
+    return None
+
+
+_VMSTAT_FIELDS = {}                                     # /proc/vmstat field name: counter or None.
+
+
+def vmstat_status():
+    ''' Parses the paging counters out of /proc/vmstat in one pass over its lines. '''
+    status = dict.fromkeys(VMSTAT_COUNTERS, 0.0)
+
+    try:
+        with open('/proc/vmstat', 'r') as data_file:
+            for line in data_file:
+                name, _, value = line.partition(' ')
+
+                if name not in _VMSTAT_FIELDS:
+                    _VMSTAT_FIELDS[name] = vmstat_counter(name)
+
+                counter = _VMSTAT_FIELDS[name]
+                if counter:
+                    status[counter] += float(value)
+
+    except IOError as e:
+        print 'ERROR: %s' % e
+        exit(UNKNOWN)
+
+    return status
+
+
+def calc_rates(first, second, elapsed):
+    ''' Pages per second of each counter, None if a counter went back (ie: reboot). '''
+    rates = {}
+
+    for k in VMSTAT_COUNTERS:
+        if second[k] < first[k]:
+            return None
+        rates[k] = (second[k] - first[k]) / elapsed
+
+    return rates
+
+
+def monotonic():
+    ''' Seconds elapsed since an arbitrary point in the past, not affected by wall clock changes. '''
+    return os.times()[4]
+
+
+def check_paging(interval):
+    first_check = vmstat_status()
+    first_time = monotonic()
+
+    sleep(interval)
+
+    second_check = vmstat_status()
+
+    return calc_rates(first_check, second_check, max(monotonic() - first_time, interval))
+
+
+def default_state_file():
+    return os.path.join(tempfile.gettempdir(), 'check_mem.%d.state' % os.getuid())
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def load_state(state_file):
+    ''' State saved by a previous run, None when missing, untrusted or not {"timestamp": number, "status": counters}. '''
+    try:
+        with os.fdopen(_open_private(state_file, os.O_RDONLY), 'r') as data_file:
+            state = json.load(data_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(state, dict) or not _is_number(state.get('timestamp')) or not isinstance(state.get('status'), dict):
+        return None
+
+    if not all(_is_number(state['status'].get(k)) for k in VMSTAT_COUNTERS):
+        return None
+
+    return state
+
+
+def lock_state(state_file):
+    ''' Exclusive lock on state_file + .lock, held until the returned file is closed. Exits UNKNOWN when not possible. '''
+    try:
+        lock_file = os.fdopen(_open_private(state_file + '.lock', os.O_WRONLY | os.O_CREAT), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+        print 'ERROR: Fail while locking paging state: %s' % e
+        exit(UNKNOWN)
+
+    return lock_file
+
+
+def save_state(state_file, state):
+    ''' Write state to a temporary file renamed over state_file, so readers never see a partial write. '''
+    fd, temp_file = tempfile.mkstemp(prefix='.check_mem.', dir=os.path.dirname(os.path.abspath(state_file)))
+    try:
+        with os.fdopen(fd, 'w') as data_file:
+            json.dump(state, data_file)
+        os.rename(temp_file, state_file)
+    except (IOError, OSError):
+        os.unlink(temp_file)
+        raise
+
+
+def check_paging_stateful(interval, state_file, max_age):
+    '''
+    Paging rates since the snapshot stored by the previous run, without sleeping.
+    Falls back to a short sleep on the first run or when the snapshot is older
+    than max_age seconds (or from before a reboot). A lock on state_file + .lock
+    serializes concurrent runs.
+    '''
+    with lock_state(state_file):
+        previous = load_state(state_file)
+        second_check = vmstat_status()
+        timestamp = monotonic()
+
+        rates = None
+        if previous and STATE_MIN_AGE <= timestamp - previous['timestamp'] <= max_age:
+            rates = calc_rates(previous['status'], second_check, timestamp - previous['timestamp'])
+
+        if rates is None:
+            first_check, first_time = second_check, timestamp
+            sleep(min(interval, STATE_MIN_AGE))
+            second_check = vmstat_status()
+            timestamp = monotonic()
+            rates = calc_rates(first_check, second_check, max(timestamp - first_time, min(interval, STATE_MIN_AGE)))
+
+        try:
+            save_state(state_file, {'timestamp': timestamp, 'status': second_check})
+        except (IOError, OSError) as e:
+            print 'ERROR: Fail while saving paging state: %s' % e
+            exit(UNKNOWN)
+
+    return rates
+
+
+def rate_state(rate, warning, critical):
+    if rate >= critical:
+        return CRITICAL
+
+    if rate >= warning:
+        return WARNING
+
+    return OK
+
+
+def print_paging(rates, swapin_warning, swapin_critical, reclaim_warning, reclaim_critical, noalert):
+    if rates is None:
+        print 'ERROR: /proc/vmstat counters went back between samples.'
+        exit(UNKNOWN)
+
+    status = max(rate_state(rates['pswpin'], swapin_warning, swapin_critical),
+                 rate_state(rates['pgscan_direct'], reclaim_warning, reclaim_critical))
+
+    if noalert:
+        status = OK
+
+    print 'Paging %s %.2f swap in/s, %.2f swap out/s, %.2f direct reclaim scans/s | %s' % (
+        STATE_NAMES[status], rates['pswpin'], rates['pswpout'], rates['pgscan_direct'], print_perfdata(rates))
+    exit(status)
+
+
+def _open_private(path, flags):
+    '''
+    Opens a file of a directory where anyone may create files, ie: CACHE_DIR or
+    the directory of the default --state-file, only if it is a regular file of
+    ours that nobody else can write. Raises OSError otherwise.
+    '''
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0600)
+    info = os.fstat(fd)
+
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 022:
+        os.close(fd)
+        raise OSError(errno.EPERM, 'untrusted file', path)
+
+    return fd
+
+
+def _read_cache(path, ttl):
+    try:
+        fd = _open_private(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        with os.fdopen(fd, 'rb') as data_file:
+            if time.time() - os.fstat(fd).st_mtime < ttl:
+                return marshal.load(data_file)
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        pass
+
+    return None
+
+
+def _write_cache(path, value):
+    try:
+        fd, temp_file = tempfile.mkstemp(prefix='.check_plugins.', dir=CACHE_DIR)
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as data_file:
+            marshal.dump(value, data_file)
+        os.rename(temp_file, path)
+    except (IOError, OSError, ValueError):
+        os.unlink(temp_file)
+
+
+def _lock_cache(path):
+    ''' Locked file descriptor of path, None when it can not be opened or locked. '''
+    try:
+        fd = _open_private(path, os.O_WRONLY | os.O_CREAT)
+    except OSError:
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except IOError:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _cached(key, ttl, load):
+    '''
+    Result of load(), shared with other runs for ttl seconds through a file in
+    CACHE_DIR, so checks started together parse their source once. Runs finding
+    the cache stale wait on a lock for the one loading it. Cache files not owned
+    by us or writable by others are ignored, load() is used whenever the cache
+    can not be. ttl 0 disables it.
+    '''
+    if not ttl:
+        return load()
+
+    path = os.path.join(CACHE_DIR, 'check_plugins.%d.%s.cache' % (os.getuid(), key))
+    value = _read_cache(path, ttl)
+
+    if value is None:
+        lock_fd = _lock_cache(path + '.lock')
+
+        if lock_fd is None:
+            _CACHE_STATS['cache_misses'] += 1
+            return load()
+
+        try:
+            value = _read_cache(path, ttl)              # loaded by another run meanwhile.
+
+            if value is None:
+                _CACHE_STATS['cache_misses'] += 1
+                value = load()
+                _write_cache(path, value)
+                return value
+        finally:
+            os.close(lock_fd)
+
+    _CACHE_STATS['cache_hits'] += 1
+    return value
+
+
 def print_perfdata(results):
     output = ''
 
@@ -70,32 +437,84 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Icinga plugin to check the amount of used memory on Linux using /proc/meminfo.')
 
     parser.add_argument('-w', '--warning',  action='store', dest='warning_threshold', type=int, default=80,
         help='Warning threshold. Returns warning if percentage of memory usage is greater than this value. Default is 80.')
     parser.add_argument('-c', '--critical', action='store', dest='critical_threshold', type=int, default=90,
         help='Critical threshold. Returns critical if percentage of memory usage is greater than this value. Default is 90.')
+    parser.add_argument('-s', '--swap', action='store_true', dest='swap',
+        help='Check swap usage too, from the same read of /proc/meminfo. Alerts with the worst state.')
+    parser.add_argument('--swap-warning', action='store', dest='swap_warning_threshold', type=int, default=80,
+        help='Warning threshold of swap usage percentage with --swap. Default is 80.')
+    parser.add_argument('--swap-critical', action='store', dest='swap_critical_threshold', type=int, default=90,
+        help='Critical threshold of swap usage percentage with --swap. Default is 90.')
+    parser.add_argument('-r', '--rates', action='store_true', dest='rates',
+        help='Check paging activity instead of usage: swap in/out, major faults and page reclaim rates in pages/s from /proc/vmstat.')
+    parser.add_argument('-i', '--interval', action='store', dest='interval', type=float, default=1,
+        help='Time delay in seconds between /proc/vmstat collects with --rates. Default is 1.')
+    parser.add_argument('--stateful', action='store_true', dest='stateful',
+        help='With --rates, report rates since the previous run, kept in a state file, instead of sleeping.')
+    parser.add_argument('--state-file', action='store', dest='state_file', type=str, default=default_state_file(),
+        help='State file used by --stateful. Default is check_mem.<uid>.state in the temporary directory.')
+    parser.add_argument('--max-age', action='store', dest='max_age', type=int, default=900,
+        help='Seconds after which a --stateful snapshot is too old to be used. Default is 900.')
+    parser.add_argument('--swapin-warning', action='store', dest='swapin_warning', type=float, default=100,
+        help='Returns warning if pages swapped in per second are at least this value with --rates. Default is 100.')
+    parser.add_argument('--swapin-critical', action='store', dest='swapin_critical', type=float, default=1000,
+        help='Returns critical if pages swapped in per second are at least this value with --rates. Default is 1000.')
+    parser.add_argument('--reclaim-warning', action='store', dest='reclaim_warning', type=float, default=1000,
+        help='Returns warning if pages scanned by direct reclaim per second are at least this value with --rates. Default is 1000.')
+    parser.add_argument('--reclaim-critical', action='store', dest='reclaim_critical', type=float, default=10000,
+        help='Returns critical if pages scanned by direct reclaim per second are at least this value with --rates. Default is 10000.')
+    parser.add_argument('--cache-ttl', action='store', dest='cache_ttl', type=float, default=0,
+        help='Seconds the parsed /proc/meminfo is shared with other runs through a cache in /dev/shm, with cache_hits and cache_misses in performance data. Default is 0, disabled.')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
             help='No alert, only check memory and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1.1')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     warning = arguments.warning_threshold
     critical = arguments.critical_threshold
     noalert = arguments.noalert
+    swap_warning = arguments.swap_warning_threshold
+    swap_critical = arguments.swap_critical_threshold
+    cache_ttl = arguments.cache_ttl
 
-    if warning > critical:
+    if warning > critical or swap_warning > swap_critical:
         print 'ERROR: warning threshold greater than critical threshold.'
         exit(UNKNOWN)
 
-    if warning == critical:
+    if warning == critical or swap_warning == swap_critical:
         print 'ERROR: warning and critical threshold are equal.'
         exit(UNKNOWN)
 
-    memory_usage = check_mem()
+    if arguments.rates:
+        if arguments.interval <= 0:
+            print 'ERROR: interval must be greater than zero.'
+            exit(UNKNOWN)
+
+        if arguments.swapin_warning > arguments.swapin_critical or arguments.reclaim_warning > arguments.reclaim_critical:
+            print 'ERROR: warning threshold greater than critical threshold.'
+            exit(UNKNOWN)
+
+        if arguments.stateful:
+            rates = check_paging_stateful(arguments.interval, arguments.state_file, arguments.max_age)
+        else:
+            rates = check_paging(arguments.interval)
+
+        print_paging(rates, arguments.swapin_warning, arguments.swapin_critical,
+                     arguments.reclaim_warning, arguments.reclaim_critical, noalert)
+
+    if arguments.swap:
+        check_mem_swap(warning, critical, swap_warning, swap_critical, noalert, cache_ttl)
+
+    memory_usage = check_mem(_cached('proc_meminfo', cache_ttl, meminfo_status))
+
+    if memory_usage and cache_ttl:
+        memory_usage.update(_CACHE_STATS)
 
     if memory_usage:
         if memory_usage['perc_inuse'] <= warning or noalert:
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Benchmark of the socket inode resolver used by check_netstat.py. Opens a
+growing number of loopback TCP connections and times netstat_tcp4() with the
+indexed resolver against the former one glob per socket lookup.
+"""
+
+import argparse
+import glob
+import os
+import re
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import check_netstat
+
+
+def _legacy_get_pid_of_inode(inode):
+    ''' The resolver check_netstat.py used before, one /proc scan per socket. '''
+    for item in glob.glob('/proc/[0-9]*/fd/[0-9]*'):
+        try:
+            if re.search(inode, os.readlink(item)):
+                return item.split('/')[2]
+        except:
+            pass
+    return None
+
+
+def open_connections(count):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+    sockets = [server]
+
+    for i in range(count):
+        client = socket.create_connection(server.getsockname())
+        peer, address = server.accept()
+        sockets.extend([client, peer])
+
+    return sockets
+
+
+def time_netstat(resolver):
+    check_netstat._INODE_MAP = None
+    check_netstat._PID_EXE.clear()
+    original = check_netstat._get_pid_of_inode
+    if resolver is not None:
+        check_netstat._get_pid_of_inode = resolver
+
+    try:
+        start = time.time()
+        rows = len([list(row) for row in check_netstat.netstat_tcp4()])  # resolve every owner.
+        elapsed = time.time() - start
+    finally:
+        check_netstat._get_pid_of_inode = original
+
+    return rows, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark check_netstat.py socket owner resolution.')
+
+    parser.add_argument('-s', '--sizes', action='store', dest='sizes', type=str, default='50,100,200,400',
+        help='Comma separated list of connection counts to benchmark. Default is 50,100,200,400.')
+    parser.add_argument('--skip-legacy', action='store_true', dest='skip_legacy',
+        help='Only time the indexed resolver.')
+
+    arguments = parser.parse_args()
+
+    print '%10s %8s %12s %12s' % ('connections', 'rows', 'indexed (s)', 'legacy (s)')
+
+    for size in [int(x) for x in arguments.sizes.split(',')]:
+        sockets = open_connections(size)
+
+        try:
+            rows, indexed = time_netstat(None)
+            if arguments.skip_legacy:
+                legacy = '-'
+            else:
+                legacy = '%.3f' % time_netstat(_legacy_get_pid_of_inode)[1]
+        finally:
+            for s in sockets:
+                s.close()
+
+        print '%10d %8d %12.3f %12s' % (size, rows, indexed, legacy)
+
+
+
+if __name__ == '__main__':
+    main()
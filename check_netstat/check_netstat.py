@@ -8,12 +8,21 @@ This file has code from:
 http://voorloopnul.com/blog/a-python-netstat-in-less-than-100-lines-of-code
 """
 
+import io
+import errno
+import fcntl
+import marshal
 import pwd
 import os
-import re
-import glob
+import socket
+import stat
+import struct
+import tempfile
+import time
 import argparse
 
+from sys import exit
+
 OK = 0
 WARNING = 1
 CRITICAL = 2
@@ -24,6 +33,10 @@ PROC_UDP4 = "/proc/net/udp"
 PROC_TCP6 = "/proc/net/tcp6"
 PROC_UDP6 = "/proc/net/udp6"
 PROC_PACKET = "/proc/net/packet"
+PROC_SOCKSTAT = "/proc/net/sockstat"
+PROC_SOCKSTAT6 = "/proc/net/sockstat6"
+PROC_SNMP = "/proc/net/snmp"
+CHUNK_SIZE = 65536                                      # read size of the /proc/net table streams.
 TCP_STATE = {
         '01':'ESTABLISHED',
         '02':'SYN_SENT',
@@ -38,37 +51,71 @@ TCP_STATE = {
         '0B':'CLOSING'
         }
 
+NETLINK_SOCK_DIAG = 4                                   # Netlink family, request and attribute
+SOCK_DIAG_BY_FAMILY = 20                                # numbers from linux/netlink.h,
+NLM_F_REQUEST = 0x01                                    # linux/sock_diag.h and linux/inet_diag.h.
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_REQ_BYTECODE = 1
+INET_DIAG_BC_JMP = 1
+INET_DIAG_BC_D_COND = 8
+TCPF_ALL = 0xFFF
+
+_INODE_MAP = None                                       # socket inode -> pid, see _get_pid_of_inode().
+_PID_EXE = {}                                           # pid -> process name.
+_UID_NAMES = {}                                         # uid -> user name, see _get_user_of_uid().
+_UID_STATS = {'hits': 0, 'misses': 0}
+CACHE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()    # tmpfs, see _cached().
+_CACHE_STATS = {'cache_hits': 0, 'cache_misses': 0}
+
+
+def _stream_table(path, columns):
+    '''
+    Stream the rows of a fixed-width /proc/net table, header excluded. The file
+    is read in large chunks into one reusable buffer and only the wanted columns
+    are copied out of it, sliced through a memoryview. columns is a list of
+    (start, end) offsets relative to the colon closing the sl column, None
+    standing for the start or the end of the line. Yields a tuple per row.
+    '''
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    fill = 0
+    header = True
 
-def _tcp4load():
-    ''' Read the table of tcp connections & remove the header  '''
-    with open(PROC_TCP4,'r') as f:
-        content = f.readlines()
-        content.pop(0)
-    return content
+    with io.open(path, 'rb', buffering=0) as table:
+        while True:
+            if fill == len(buf):                        # a single line bigger than the buffer.
+                buf = buf + bytearray(len(buf))
+                view = memoryview(buf)
 
+            read = table.readinto(view[fill:])
+            if not read:
+                return
 
-def _tcp6load():
-    ''' Read the table of tcpv6 connections & remove the header'''
-    with open(PROC_TCP6,'r') as f:
-        content = f.readlines()
-        content.pop(0)
-    return content
+            fill += read
+            start = 0
 
+            while True:
+                end = buf.find('\n', start, fill)
+                if end < 0:
+                    break
 
-def _udp4load():
-    '''Read the table of udp connections & remove the header '''
-    with open(PROC_UDP4,'r') as f:
-        content = f.readlines()
-        content.pop(0)
-    return content
+                if header:
+                    header = False
+                else:
+                    colon = buf.find(':', start, end)
+                    yield tuple(view[start if a is None else colon + a:end if b is None else colon + b].tobytes()
+                                for a, b in columns)
+                start = end + 1
 
+            fill -= start                               # keep the partial last line for the next read.
+            buf[:fill] = buf[start:start + fill]
 
-def _udp6load():
-    '''Read the table of udp connections & remove the header '''
-    with open(PROC_UDP6,'r') as f:
-        content = f.readlines()
-        content.pop(0)
-    return content
+
+def _socket_columns(width):
+    ''' sl, local_address, rem_address, st and the rest of a row whose addresses are width wide. '''
+    return [(None, 1), (2, 2 + width), (3 + width, 3 + 2 * width), (4 + 2 * width, 6 + 2 * width), (6 + 2 * width, None)]
 
 
 def _packetload():
@@ -108,32 +155,100 @@ def _convert_ipv6_port(array):
     return _ip6(host),_hex2dec(port)
 
 
-def netstat_tcp4():
+class Connection(object):
     '''
-    Function to return a list with status of tcp connections on Linux systems.
+    A row of a socket table. Supports indexing like the list it replaces:
+    [id, user, local address, remote address, state, pid, exe]. The owner of the
+    socket (user, pid and process name) is looked up only when it is read, so
+    callers interested in addresses and state never scan /proc/*/fd.
+    '''
+
+    FIELDS = ('id', 'user', 'local', 'remote', 'state', 'pid', 'exe')
+
+    __slots__ = ('id', 'uid', 'local', 'remote', 'state', 'inode')
+
+    def __init__(self, conn_id, uid, local, remote, state, inode):
+        self.id = conn_id
+        self.uid = uid
+        self.local = local
+        self.remote = remote
+        self.state = state
+        self.inode = inode
+
+    @property
+    def user(self):
+        return _get_user_of_uid(self.uid)
+
+    @property
+    def pid(self):
+        return _get_pid_of_inode(self.inode)
+
+    @property
+    def exe(self):
+        return _get_exe_of_pid(self.pid)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [getattr(self, field) for field in self.FIELDS[index]]
+        return getattr(self, self.FIELDS[index])
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.FIELDS)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def _iter_sockets(path, width, convert, stateless=False):
+    for conn_id, local, remote, state, rest in _stream_table(path, _socket_columns(width)):
+        l_host,l_port = convert(local)                  # Convert ipaddress and port from hex to decimal.
+        r_host,r_port = convert(remote)
+        rest = rest.split()
+        uid = rest[3]                                   # User, pid and process name are
+        inode = rest[5]                                 # resolved from uid and inode on demand.
+
+        if stateless:
+            state = 'Stateless'                         # UDP is stateless
+        else:
+            state = TCP_STATE[state]
+
+        yield Connection(conn_id.strip(), uid, l_host+':'+l_port, r_host+':'+r_port, state, inode)
+
+
+def iter_tcp4():
+    '''
+    Generator of the tcp connections on Linux systems, one Connection at a time.
     Please note that in order to return the pid of of a network process running on the
     system, this script must be ran as root.
     '''
+    return _iter_sockets(PROC_TCP4, 13, _convert_ipv4_port)
+
+
+def iter_tcp6():
+    ''' Generator of the tcp connections utilizing ipv6, see iter_tcp4(). '''
+    return _iter_sockets(PROC_TCP6, 37, _convert_ipv6_port)
+
+
+def iter_udp4():
+    ''' Generator of the udp connections, see iter_tcp4(). UDP is stateless, so state will always be Stateless. '''
+    return _iter_sockets(PROC_UDP4, 13, _convert_ipv4_port, stateless=True)
+
+
+def iter_udp6():
+    ''' Generator of the udp connections utilizing ipv6, see iter_udp4(). '''
+    return _iter_sockets(PROC_UDP6, 37, _convert_ipv6_port, stateless=True)
 
-    tcpcontent =_tcp4load()
-    tcpresult = []
-    for line in tcpcontent:
-        line_array = _remove_empty(line.split(' '))     # Split lines and remove empty spaces.
-        l_host,l_port = _convert_ipv4_port(line_array[1]) # Convert ipaddress and port from hex to decimal.
-        r_host,r_port = _convert_ipv4_port(line_array[2])
-        tcp_id = line_array[0]
-        state = TCP_STATE[line_array[3]]
-        uid = pwd.getpwuid(int(line_array[7]))[0]       # Get user from UID.
-        inode = line_array[9]                           # Need the inode to get process pid.
-        pid = _get_pid_of_inode(inode)                  # Get pid prom inode.
-        try:                                            # try read the process name.
-            exe = os.readlink('/proc/'+pid+'/exe')
-        except:
-            exe = None
 
-        nline = [tcp_id, uid, l_host+':'+l_port, r_host+':'+r_port, state, pid, exe]
-        tcpresult.append(nline)
-    return tcpresult
+def netstat_tcp4():
+    '''
+    Function to return a list with status of tcp connections on Linux systems.
+    Please note that in order to return the pid of of a network process running on the
+    system, this script must be ran as root.
+    '''
+    return list(iter_tcp4())
 
 
 def netstat_tcp6():
@@ -141,25 +256,7 @@ def netstat_tcp6():
     This function returns a list of tcp connections utilizing ipv6. Please note that in order to return the pid of of a
     network process running on the system, this script must be ran as root.
     '''
-    tcpcontent = _tcp6load()
-    tcpresult = []
-    for line in tcpcontent:
-        line_array = _remove_empty(line.split(' '))
-        l_host,l_port = _convert_ipv6_port(line_array[1])
-        r_host,r_port = _convert_ipv6_port(line_array[2])
-        tcp_id = line_array[0]
-        state = TCP_STATE[line_array[3]]
-        uid = pwd.getpwuid(int(line_array[7])) [0]
-        inode = line_array[9]
-        pid = _get_pid_of_inode(inode)
-        try:                                            # try read the process name.
-            exe = os.readlink('/proc/'+pid+'/exe')
-        except:
-            exe = None
-
-        nline = [tcp_id, uid, l_host+':'+l_port, r_host+':'+r_port, state, pid, exe]
-        tcpresult.append(nline)
-    return tcpresult
+    return list(iter_tcp6())
 
 
 def netstat_udp4():
@@ -168,26 +265,7 @@ def netstat_udp4():
     state will always be blank. Please note that in order to return the pid of of a network process running on the
     system, this script must be ran as root.
     '''
-
-    udpcontent =_udp4load()
-    udpresult = []
-    for line in udpcontent:
-        line_array = _remove_empty(line.split(' '))
-        l_host,l_port = _convert_ipv4_port(line_array[1])
-        r_host,r_port = _convert_ipv4_port(line_array[2])
-        udp_id = line_array[0]
-        udp_state ='Stateless' #UDP is stateless
-        uid = pwd.getpwuid(int(line_array[7]))[0]
-        inode = line_array[9]
-        pid = _get_pid_of_inode(inode)
-        try:
-            exe = os.readlink('/proc/'+pid+'/exe')
-        except:
-            exe = None
-
-        nline = [udp_id, uid, l_host+':'+l_port, r_host+':'+r_port, udp_state, pid, exe]
-        udpresult.append(nline)
-    return udpresult
+    return list(iter_udp4())
 
 
 def netstat_udp6():
@@ -196,26 +274,7 @@ def netstat_udp6():
     be blank. Please note that in order to return the pid of of a network process running on the system, this script
     must be ran as root.
     '''
-
-    udpcontent =_udp6load()
-    udpresult = []
-    for line in udpcontent:
-        line_array = _remove_empty(line.split(' '))
-        l_host,l_port = _convert_ipv6_port(line_array[1])
-        r_host,r_port = _convert_ipv6_port(line_array[2])
-        udp_id = line_array[0]
-        udp_state ='Stateless' #UDP is stateless
-        uid = pwd.getpwuid(int(line_array[7]))[0]
-        inode = line_array[9]
-        pid = _get_pid_of_inode(inode)
-        try:
-            exe = os.readlink('/proc/'+pid+'/exe')
-        except:
-            exe = None
-
-        nline = [udp_id, uid, l_host+':'+l_port, r_host+':'+r_port, udp_state, pid, exe]
-        udpresult.append(nline)
-    return udpresult
+    return list(iter_udp6())
 
 
 def packet_socket():
@@ -229,109 +288,457 @@ def packet_socket():
         line_array = _remove_empty(line.split(' '))
         inode = line_array[8].rstrip()
         pid = _get_pid_of_inode(inode)
-        try:
-            exe = os.readlink('/proc/'+pid+'/exe')
-        except:
-            exe = None
+        exe = _get_exe_of_pid(pid)
 
         nline = [pid, exe]
         packetresult.append(nline)
     return packetresult
 
 
+def _build_inode_map():
+    '''
+    Walk the file descriptors of every running process once and map each
+    socket inode to the pid holding it.
+    '''
+    inodes = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = '/proc/' + pid + '/fd'
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:                                 # process is gone or not ours.
+            continue
+        for fd in fds:
+            try:
+                link = os.readlink(fd_dir + '/' + fd)
+            except OSError:
+                continue
+            if link.startswith('socket:['):
+                inodes.setdefault(link[8:-1], pid)
+    return inodes
+
+
 def _get_pid_of_inode(inode):
     '''
-    To retrieve the process pid, check every running process and look for one using
-    the given inode.
+    To retrieve the process pid, look the given inode up in the socket inode map.
+    The map is built on first use, so /proc is scanned only once per run.
+    '''
+    global _INODE_MAP
+    if _INODE_MAP is None:
+        _INODE_MAP = _build_inode_map()
+    return _INODE_MAP.get(inode)
+
+
+def _get_user_of_uid(uid):
+    '''
+    Get user from UID. Sockets belong to a handful of users, so each uid is looked
+    up only once (NSS may go over the network). Unknown uids are kept numeric.
     '''
-    for item in glob.glob('/proc/[0-9]*/fd/[0-9]*'):
+    if uid in _UID_NAMES:
+        _UID_STATS['hits'] += 1
+    else:
+        _UID_STATS['misses'] += 1
         try:
-            if re.search(inode,os.readlink(item)):
-                return item.split('/')[2]
+            _UID_NAMES[uid] = pwd.getpwuid(int(uid))[0]
+        except KeyError:
+            _UID_NAMES[uid] = uid
+    return _UID_NAMES[uid]
+
+
+def _get_exe_of_pid(pid):
+    ''' Read the process name of pid, remembering it for the other sockets of the same process. '''
+    if pid not in _PID_EXE:
+        try:
+            _PID_EXE[pid] = os.readlink('/proc/'+pid+'/exe')
         except:
-            pass
-    return None
+            _PID_EXE[pid] = None
+    return _PID_EXE[pid]
 
 
-def ipv4toipv6(ipv4):
-    numbers = ipv4.split('.')
-    ipv6 = '00:00:00:00:00:00:00:00:00:00:FF:FF:' + '{0:02X}:{1:02X}:{2:02X}:{3:02X}'.format(int(numbers[0]), int(numbers[1]), int(numbers[2]), int(numbers[3]))
-    return ipv6
+def _hex_address(host, port):
+    '''
+    Encode host and port the way the kernel prints them in /proc/net/tcp*: the
+    address as 32 bits hex words in host byte order and the port in hex.
+    Returns the IPv4 form and the IPv4-mapped IPv6 form (::ffff:host) found in
+    tcp6.
+    '''
+    address = '%08X' % struct.unpack('=I', socket.inet_aton(host))[0]
+    hex_port = '%04X' % port
+    return address + ':' + hex_port, '0000000000000000FFFF0000' + address + ':' + hex_port
 
 
 def print_debug():
     print "\nLegend: Connection ID, UID, localhost:localport, remotehost:remoteport, state, pid, exe name"
     print "\nTCP (v4) Results:\n"
-    for conn_tcp in netstat_tcp4():
+    for conn_tcp in iter_tcp4():
         print conn_tcp
     print "\nTCP (v6) Results:\n"
-    for conn_tcp6 in netstat_tcp6():
+    for conn_tcp6 in iter_tcp6():
         print conn_tcp6
     print "\nUDP (v4) Results:\n"
-    for conn_udp in netstat_udp4():
+    for conn_udp in iter_udp4():
         print conn_udp
     print "\nUDP (v6) Results:\n"
-    for conn_udp6 in netstat_udp6():
+    for conn_udp6 in iter_udp6():
         print conn_udp6
     print "\nPacket Socket Results:\n"
     for pack_sock in packet_socket():
         print pack_sock
+    print "\nUID cache: %d hit(s), %d miss(es)" % (_UID_STATS['hits'], _UID_STATS['misses'])
+
+
+def _diag_bytecode(targets):
+    '''
+    inet_diag filter accepting sockets whose remote end is any of the (host, port)
+    targets. The kernel applies an AF_INET condition to IPv4-mapped addresses of
+    AF_INET6 sockets too, so the same filter serves both dumps.
+    '''
+    conditions = []
+    for host, port in targets:
+        address = socket.inet_aton(host)
+        conditions.append((struct.pack('=BBxxi', socket.AF_INET, 32, port) + address))
+
+    bytecode = ''
+    remaining = sum(4 + len(condition) + 4 for condition in conditions)
+
+    # Each condition is followed by a jump to the end of the program (accept)
+    # taken on match; else the condition skips the jump and tries the next one,
+    # the last one jumps past the end (reject). The distance to the end goes in
+    # the 16 bits "no" of the jump, the 8 bits "yes" of a condition only has to
+    # reach the jump right after it.
+    for i, condition in enumerate(conditions):
+        length = 4 + len(condition)                     # inet_diag_bc_op + inet_diag_hostcond + address.
+        no = length + 8 if i == len(conditions) - 1 else length + 4
+        bytecode += struct.pack('=BBH', INET_DIAG_BC_D_COND, length, no) + condition
+        bytecode += struct.pack('=BBH', INET_DIAG_BC_JMP, 4, remaining - length)
+        remaining -= length + 4
+
+    return bytecode
+
+
+def _diag_dump(family, states, bytecode):
+    '''
+    Dump TCP sockets of family through NETLINK_SOCK_DIAG. Returns a list of
+    (rem_address, state) pairs in the same hex form as /proc/net/tcp*.
+    '''
+    attribute = struct.pack('=HH', 4 + len(bytecode), INET_DIAG_REQ_BYTECODE) + bytecode
+    request = struct.pack('=BBBxI', family, socket.IPPROTO_TCP, 0, states) + '\0' * 48 + attribute
+    message = struct.pack('=IHHII', 16 + len(request), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + request
+
+    rows = []
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    try:
+        sock.sendto(message, (0, 0))
+
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+
+            while offset < len(data):
+                length, msg_type = struct.unpack_from('=IH', data, offset)
+
+                if msg_type == NLMSG_DONE:
+                    return rows
 
+                if msg_type == NLMSG_ERROR:
+                    error = -struct.unpack_from('=i', data, offset + 16)[0]
+                    raise socket.error(error, os.strerror(error))
 
-def check_netstat(dhost, dport):
-    results = { 'connections': 0, 'established': 0, 'syn_sent': 0,
-                'syn_recv': 0, 'fin_wait1': 0, 'fin_wait2': 0,
-                'time_wait': 0, 'close': 0, 'close_wait': 0,
-                'last_ack': 0, 'listen': 0, 'closing': 0 }
+                # inet_diag_msg: family, state, timer, retrans, then inet_diag_sockid.
+                state, dport = struct.unpack_from('=xB2x2x2s', data, offset + 16)
+                dst = data[offset + 40:offset + 56]
 
-    tcp4 = netstat_tcp4()
-    connections = tcp4 + netstat_tcp6()
+                if family == socket.AF_INET:
+                    address = '%08X' % struct.unpack('=I', dst[:4])
+                else:
+                    address = '%08X%08X%08X%08X' % struct.unpack('=4I', dst)
 
-    destination = '%s:%d' % (dhost, dport)
-    destination_ipv6 = '%s:%d' % (ipv4toipv6(dhost), dport)
+                rows.append((address + ':%04X' % struct.unpack('>H', dport), '%02X' % state))
+                offset += (length + 3) & ~3
+    finally:
+        sock.close()
 
-    for connection in connections:
-        source, target, state = connection[2], connection[3], connection[4]
 
-        if target == destination or target == destination_ipv6:
-            results['connections'] += 1
+def _netlink_rows(targets, states=TCPF_ALL):
+    ''' TCP sockets to any of targets, filtered by the kernel through sock_diag. '''
+    bytecode = _diag_bytecode(targets)
+
+    return _diag_dump(socket.AF_INET, states, bytecode) + _diag_dump(socket.AF_INET6, states, bytecode)
+
+
+def _procfs_rows():
+    '''
+    (rem_address, state) of every TCP socket in /proc/net/tcp and /proc/net/tcp6,
+    streamed without splitting or decoding the rows.
+    '''
+    for path, width in ((PROC_TCP4, 13), (PROC_TCP6, 37)):
+        for row in _stream_table(path, _socket_columns(width)[2:4]):
+            yield row
 
-            if state == 'ESTABLISHED':
-                results['established'] += 1
 
-            if state == 'SYN_SENT':
-                results['syn_sent'] += 1
+def _procfs_histogram():
+    ''' Number of TCP sockets per (rem_address, state), all check_targets() needs of the tables. '''
+    histogram = {}
 
-            if state == 'SYN_RECV':
-                results['syn_recv'] += 1
+    for row in _procfs_rows():
+        histogram[row] = histogram.get(row, 0) + 1
 
-            if state == 'FIN_WAIT1':
-                results['fin_wait1'] += 1
+    return histogram
 
-            if state == 'FIN_WAIT2':
-                results['fin_wait2'] += 1
 
-            if state == 'TIME_WAIT':
-                results['time_wait'] += 1
+def _new_results():
+    return { 'connections': 0, 'established': 0, 'syn_sent': 0,
+             'syn_recv': 0, 'fin_wait1': 0, 'fin_wait2': 0,
+             'time_wait': 0, 'close': 0, 'close_wait': 0,
+             'last_ack': 0, 'listen': 0, 'closing': 0 }
 
-            if state == 'CLOSE':
-                results['close'] += 1
 
-            if state == 'CLOSE_WAIT':
-                results['close_wait'] += 1
+def check_targets(targets, netlink=False, cache_ttl=0):
+    '''
+    Count connections to every (host, port) of targets in a single pass over the
+    TCP tables. Returns a dict of results per target; the cost of the pass does
+    not depend on the number of targets.
+    '''
+    results = {}
+    index = {}                                          # hex rem_address -> results of its target.
 
-            if state == 'LAST_ACK':
-                results['last_ack'] += 1
+    for target in targets:
+        results[target] = _new_results()
+        for key in _hex_address(*target):
+            index[key] = results[target]
 
-            if state == 'LISTEN':
-                results['listen'] += 1
+    rows = None
 
-            if state == 'CLOSED':
-                results['closed'] += 1
+    if netlink:
+        try:
+            rows = _netlink_rows(results.keys())
+        except (socket.error, AttributeError):          # no AF_NETLINK or no sock_diag in kernel.
+            rows = None
+        except struct.error:                            # too many targets for one filter.
+            rows = None
+
+    if rows is not None:
+        counts = ((row, 1) for row in rows)
+    elif cache_ttl:
+        counts = _cached('proc_net_tcp', cache_ttl, _procfs_histogram).iteritems()
+    else:
+        counts = ((row, 1) for row in _procfs_rows())
+
+    for (remote, state), count in counts:
+        result = index.get(remote)
+
+        if result is not None and state in TCP_STATE:
+            result['connections'] += count
+            result[TCP_STATE[state].lower()] += count
 
     return results
 
 
+def check_netstat(dhost, dport, netlink=False, cache_ttl=0):
+    return check_targets([(dhost, dport)], netlink, cache_ttl)[(dhost, dport)]
+
+
+def parse_targets(spec, default_port, minimal, maximum):
+    '''
+    Parse a comma separated list of host[:port[:min:max]] targets, or @file with
+    one target per line. Returns a list of (host, port, min, max).
+    '''
+    if spec.startswith('@'):
+        with open(spec[1:], 'r') as targets_file:
+            entries = [line.split('#')[0].strip() for line in targets_file]
+    else:
+        entries = spec.split(',')
+
+    targets = []
+    for entry in [x.strip() for x in entries if x.strip()]:
+        fields = entry.split(':')
+
+        if len(fields) not in (1, 2, 4):
+            raise ValueError('invalid target %s, expected host[:port[:min:max]]' % entry)
+
+        port = int(fields[1]) if len(fields) > 1 else default_port
+        if port is None:
+            raise ValueError('no port given for target %s' % entry)
+
+        if len(fields) == 4:
+            targets.append((fields[0], port, int(fields[2]), int(fields[3])))
+        else:
+            targets.append((fields[0], port, minimal, maximum))
+
+        try:
+            socket.inet_aton(fields[0])
+        except socket.error:
+            raise ValueError('invalid target %s, expected an IPv4 address' % entry)
+
+    if not targets:
+        raise ValueError('no targets given')
+
+    return targets
+
+
+def _read_sockstat(path):
+    ''' Parse /proc/net/sockstat* lines like "TCP: inuse 5 orphan 0" into a dict per protocol. '''
+    sockstat = {}
+    with open(path, 'r') as f:
+        for line in f:
+            protocol, values = line.split(':', 1)
+            values = values.split()
+            sockstat[protocol] = dict((values[i], int(values[i + 1])) for i in range(0, len(values) - 1, 2))
+    return sockstat
+
+
+def _read_snmp(path):
+    ''' Parse the header and value line pairs of /proc/net/snmp into a dict per protocol. '''
+    snmp = {}
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    for header, values in zip(lines[0::2], lines[1::2]):
+        protocol, names = header.split(':', 1)
+        snmp[protocol] = dict(zip(names.split(), [int(x) for x in values.split(':', 1)[1].split()]))
+    return snmp
+
+
+def check_summary():
+    '''
+    Host wide TCP counters, read from the totals the kernel already keeps in
+    /proc/net/sockstat, sockstat6 and snmp instead of scanning every socket.
+    established is the kernel CurrEstab counter, which includes CLOSE_WAIT.
+    '''
+    sockstat = _read_sockstat(PROC_SOCKSTAT)
+    try:
+        sockstat6 = _read_sockstat(PROC_SOCKSTAT6)
+    except IOError:                                     # IPv6 disabled.
+        sockstat6 = {}
+    tcp = _read_snmp(PROC_SNMP)['Tcp']
+
+    results = {
+        'established': tcp['CurrEstab'],
+        'time_wait': sockstat['TCP']['tw'],
+        'orphan': sockstat['TCP']['orphan'],
+        'inuse': sockstat['TCP']['inuse'] + sockstat6.get('TCP6', {}).get('inuse', 0),
+        'alloc': sockstat['TCP']['alloc'],
+        'mem': sockstat['TCP']['mem'] * os.sysconf('SC_PAGE_SIZE') / 1024,
+        'sockets_used': sockstat['sockets']['used'],
+        'active_opens': tcp['ActiveOpens'],
+        'passive_opens': tcp['PassiveOpens'],
+    }
+
+    return results
+
+
+def print_summary(minimal, maximum, noalert):
+    try:
+        results = check_summary()
+    except (IOError, KeyError, ValueError) as e:
+        print 'ERROR: Fail while reading socket counters: %s' % e
+        exit(UNKNOWN)
+
+    if results['established'] >= minimal and (maximum is None or results['established'] <= maximum) or noalert:
+        print 'Netstat %s %d established connection(s) | %s' % ('OK', results['established'], print_perfdata(results))
+        exit(OK)
+    else:
+        print 'Netstat %s %d established connection(s) | %s' % ('CRITICAL', results['established'], print_perfdata(results))
+        exit(CRITICAL)
+
+
+def _open_cache(path, flags):
+    '''
+    Opens a file of CACHE_DIR, where anyone may create files, only if it is a
+    regular file of ours that nobody else can write. Raises OSError otherwise.
+    '''
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0600)
+    info = os.fstat(fd)
+
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 022:
+        os.close(fd)
+        raise OSError(errno.EPERM, 'untrusted cache file', path)
+
+    return fd
+
+
+def _read_cache(path, ttl):
+    try:
+        fd = _open_cache(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        with os.fdopen(fd, 'rb') as data_file:
+            if time.time() - os.fstat(fd).st_mtime < ttl:
+                return marshal.load(data_file)
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        pass
+
+    return None
+
+
+def _write_cache(path, value):
+    try:
+        fd, temp_file = tempfile.mkstemp(prefix='.check_plugins.', dir=CACHE_DIR)
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as data_file:
+            marshal.dump(value, data_file)
+        os.rename(temp_file, path)
+    except (IOError, OSError, ValueError):
+        os.unlink(temp_file)
+
+
+def _lock_cache(path):
+    ''' Locked file descriptor of path, None when it can not be opened or locked. '''
+    try:
+        fd = _open_cache(path, os.O_WRONLY | os.O_CREAT)
+    except OSError:
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except IOError:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _cached(key, ttl, load):
+    '''
+    Result of load(), shared with other runs for ttl seconds through a file in
+    CACHE_DIR, so checks started together parse their source once. Runs finding
+    the cache stale wait on a lock for the one loading it. Cache files not owned
+    by us or writable by others are ignored, load() is used whenever the cache
+    can not be. ttl 0 disables it.
+    '''
+    if not ttl:
+        return load()
+
+    path = os.path.join(CACHE_DIR, 'check_plugins.%d.%s.cache' % (os.getuid(), key))
+    value = _read_cache(path, ttl)
+
+    if value is None:
+        lock_fd = _lock_cache(path + '.lock')
+
+        if lock_fd is None:
+            _CACHE_STATS['cache_misses'] += 1
+            return load()
+
+        try:
+            value = _read_cache(path, ttl)              # loaded by another run meanwhile.
+
+            if value is None:
+                _CACHE_STATS['cache_misses'] += 1
+                value = load()
+                _write_cache(path, value)
+                return value
+        finally:
+            os.close(lock_fd)
+
+    _CACHE_STATS['cache_hits'] += 1
+    return value
+
+
 def print_perfdata(results):
     output = ''
 
@@ -341,21 +748,57 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def check_multiple(targets, netlink, noalert, cache_ttl=0):
+    results = check_targets([(host, port) for host, port, target_min, target_max in targets], netlink, cache_ttl)
+
+    status = OK
+    failed = []
+    perfdata = ''
+
+    for host, port, target_min, target_max in targets:
+        result = results[(host, port)]
+
+        if not noalert and (result['established'] < target_min or result['established'] > target_max):
+            status = CRITICAL
+            failed.append('%s:%d %d' % (host, port, result['established']))
+
+        for k, v in result.iteritems():
+            perfdata += '\'%s:%d_%s\'=%.2f ' % (host, port, k, v)
+
+    if cache_ttl:
+        perfdata += print_perfdata(_CACHE_STATS)
+
+    if failed:
+        print 'Netstat %s %d of %d target(s) out of range: %s established | %s' % ('CRITICAL', len(failed), len(targets), ', '.join(failed), perfdata)
+    else:
+        print 'Netstat %s %d target(s) in range | %s' % ('OK', len(targets), perfdata)
+
+    exit(status)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Icinga plugin to check network connections on Linux using /proc/net.')
 
-    parser.add_argument('--min', action='store', dest='minimal', type=int, default=1,
-            help='Alerts critical state if connection number is bellow this minimal number.')
-    parser.add_argument('--max', action='store', dest='maximum', type=int, default=2,
-            help='Alerts critical state if connection number is above this maximum number.')
-    parser.add_argument('-H', '--host', action='store', dest='host', type=str, help='Target host network address.')
-    parser.add_argument('-p', '--port', action='store', dest='port', type=int, help='Target host port number.')
+    parser.add_argument('--min', action='store', dest='minimal', type=int,
+            help='Alerts critical state if connection number is bellow this minimal number. Default is 1 for hosts, 0 without a host.')
+    parser.add_argument('--max', action='store', dest='maximum', type=int,
+            help='Alerts critical state if connection number is above this maximum number. Default is 2 for hosts, no limit without a host.')
+    parser.add_argument('-H', '--host', action='store', dest='host', type=str,
+            help='Target host network address. Also accepts a comma separated list of host[:port[:min:max]] targets, '
+                 'or @FILE with one target per line, all counted in a single pass. Without a host, checks the host wide '
+                 'established connections from the kernel counters in /proc/net/sockstat and /proc/net/snmp.')
+    parser.add_argument('-p', '--port', action='store', dest='port', type=int, help='Target host port number, default for targets without one.')
+    parser.add_argument('--netlink', action='store_true', dest='netlink',
+            help='Collect connections through sock_diag netlink, filtered by the kernel. Falls back to /proc/net when unavailable.')
+    parser.add_argument('--cache-ttl', action='store', dest='cache_ttl', type=float, default=0,
+            help='Seconds the parsed TCP tables are shared with other runs through a cache in /dev/shm, with cache_hits and cache_misses '
+                 'in performance data. Not used with --netlink. Default is 0, disabled.')
     parser.add_argument('-d', '--debug', action='store_true', dest='debug')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
             help='No alert, only check network status and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1.1')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     minimal = arguments.minimal
     maximum = arguments.maximum
@@ -363,16 +806,39 @@ def main():
     dport = arguments.port
     noalert = arguments.noalert
     debug = arguments.debug
+    netlink = arguments.netlink
+    cache_ttl = arguments.cache_ttl
 
     if debug:
 	print_debug()
 	exit(OK)
 
-    if minimal > maximum:
+    if minimal is not None and maximum is not None and minimal > maximum:
         print 'ERROR: minimal threshold greater than maximum threshold.'
         exit(UNKNOWN)
 
-    results = check_netstat(dhost, dport)
+    if dhost is None:
+        print_summary(minimal or 0, maximum, noalert)
+
+    try:
+        targets = parse_targets(dhost, dport, 1 if minimal is None else minimal, 2 if maximum is None else maximum)
+    except (IOError, ValueError) as e:
+        print 'ERROR: %s' % e
+        exit(UNKNOWN)
+
+    for host, port, target_min, target_max in targets:
+        if target_min > target_max:
+            print 'ERROR: minimal threshold greater than maximum threshold for %s:%d.' % (host, port)
+            exit(UNKNOWN)
+
+    if len(targets) > 1 or dhost.startswith('@'):
+        check_multiple(targets, netlink, noalert, cache_ttl)
+
+    dhost, dport, minimal, maximum = targets[0]
+    results = check_netstat(dhost, dport, netlink, cache_ttl)
+
+    if results and cache_ttl:
+        results.update(_CACHE_STATS)
 
     if results:
         if noalert:
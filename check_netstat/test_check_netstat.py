@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+This file is part of ultrav check_plugins project
+http://github.com/viniciusfs/check_plugins
+
+Tests of check_netstat.py helpers that do not need live sockets, run with:
+python -m unittest discover -s check_netstat
+"""
+
+import os
+import socket
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import check_netstat
+
+
+def run_bytecode(bytecode, address, port):
+    '''
+    Checks bytecode the way the kernel audits it (inet_diag_bc_audit) and runs it
+    against a remote address and port (inet_diag_bc_run) for D_COND and JMP ops.
+    '''
+    offset, length = 0, len(bytecode)
+    while length > 0:                                   # audit walks the "yes" chain.
+        code, yes, no = struct.unpack_from('=BBH', bytecode, offset)
+        min_len = 4 + (12 if code == check_netstat.INET_DIAG_BC_D_COND else 0)
+        assert min_len <= no <= length + 4 and no % 4 == 0
+        assert min_len <= yes <= length + 4 and yes % 4 == 0
+        offset, length = offset + yes, length - yes
+
+    offset, length = 0, len(bytecode)
+    while length > 0:
+        code, yes, no = struct.unpack_from('=BBH', bytecode, offset)
+        match = False
+
+        if code == check_netstat.INET_DIAG_BC_D_COND:
+            family, prefix, cond_port = struct.unpack_from('=BBxxi', bytecode, offset + 4)
+            match = cond_port == port and bytecode[offset + 12:offset + 16] == socket.inet_aton(address)
+
+        step = yes if match else no
+        offset, length = offset + step, length - step
+
+    return length == 0
+
+
+class DiagBytecodeTest(unittest.TestCase):
+
+    def targets(self, count):
+        return [('10.0.%d.%d' % (i // 250, i % 250), 1000 + i) for i in range(count)]
+
+    def test_matches_any_target(self):
+        for count in (1, 2, 16, 17, 30, 100):
+            targets = self.targets(count)
+            bytecode = check_netstat._diag_bytecode(targets)
+
+            for host, port in (targets[0], targets[count // 2], targets[-1]):
+                self.assertTrue(run_bytecode(bytecode, host, port))
+
+            self.assertFalse(run_bytecode(bytecode, '10.255.0.1', 1000))
+            self.assertFalse(run_bytecode(bytecode, targets[-1][0], 1))
+
+    def test_too_many_targets(self):
+        self.assertRaises(struct.error, check_netstat._diag_bytecode, self.targets(4000))
+
+
+class ParseTargetsTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertRaises(ValueError, check_netstat.parse_targets, ',', 80, 1, 2)
+
+    def test_hostname(self):
+        self.assertRaises(ValueError, check_netstat.parse_targets, 'localhost:80', None, 1, 2)
+
+    def test_targets(self):
+        self.assertEqual(check_netstat.parse_targets('10.0.0.1:80,10.0.0.2:81:3:4', None, 1, 2),
+            [('10.0.0.1', 80, 1, 2), ('10.0.0.2', 81, 3, 4)])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,11 +5,18 @@ This file is part of ultrav check_plugins project
 http://github.com/viniciusfs/check_plugins
 """
 
-import re
 import argparse
+import errno
+import fcntl
+import fnmatch
+import json
+import os
+import socket
+import stat
+import struct
+import tempfile
 
 from collections import defaultdict
-from copy import deepcopy
 from sys import exit
 from time import sleep
 
@@ -19,6 +26,19 @@ WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+DEV_FIELDS = ('rx_bytes', 'rx_packets', 'rx_errs', 'rx_drop', 'rx_fifo', 'rx_frame', 'rx_compressed', 'rx_multicast',
+              'tx_bytes', 'tx_packets', 'tx_errs', 'tx_drop', 'tx_fifo', 'tx_colls', 'tx_carrier', 'tx_compressed')
+
+NETLINK_ROUTE = 0                                       # Netlink family, message and attribute
+RTM_GETLINK = 18                                        # numbers from linux/netlink.h,
+NLM_F_REQUEST = 0x01                                    # linux/rtnetlink.h and linux/if_link.h.
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+IFLA_IFNAME = 3
+IFLA_STATS64 = 23
+
+STATE_MIN_AGE = 1                                       # seconds, younger counters are too close to diff.
 
 
 def read_procfs():
@@ -33,34 +53,134 @@ def read_procfs():
         exit(UNKNOWN)
 
 
-def iface_status(iface):
-    regex = re.compile(r'%s:(.*?)(?P<rx_bytes>\d+)\s+(?P<rx_packets>\d+)\s+(?P<rx_errs>\d+)\s+(?P<rx_drop>\d+)\s+(?P<rx_fifo>\d+)\s+(?P<rx_frame>\d+)\s+(?P<rx_compressed>\d+)\s+(?P<rx_multicast>\d+)\s+(?P<tx_bytes>\d+)\s+(?P<tx_packets>\d+)\s+(?P<tx_errs>\d+)\s+(?P<tx_drop>\d+)\s+(?P<tx_fifo>\d+)\s+(?P<tx_colls>\d+)\s+(?P<tx_compressed>\d+)' % iface)
-    output = read_procfs()
-    match = regex.search(output)
+def net_dev_status(output=None):
+    ''' Parses /proc/net/dev in a single pass into a dict of counters per interface. '''
+    if output is None:
+        output = read_procfs()
 
-    if match:
-        status = dict((k, float(v)) for k, v in match.groupdict().iteritems())
-        return status
-    else:
-        return False
+    status = {}
+
+    for line in output.split('\n')[2:]:
+        iface, sep, counters = line.partition(':')
+
+        if sep:
+            status[iface.strip()] = dict(zip(DEV_FIELDS, [float(x) for x in counters.split()]))
+
+    return status
+
+
+def _stats64_counters(stats):
+    ''' /proc/net/dev counters from a struct rtnl_link_stats64, summed the way the kernel prints them. '''
+    (rx_packets, tx_packets, rx_bytes, tx_bytes, rx_errors, tx_errors, rx_dropped, tx_dropped, multicast,
+     collisions, rx_length_errors, rx_over_errors, rx_crc_errors, rx_frame_errors, rx_fifo_errors,
+     rx_missed_errors, tx_aborted_errors, tx_carrier_errors, tx_fifo_errors, tx_heartbeat_errors,
+     tx_window_errors, rx_compressed, tx_compressed) = struct.unpack_from('=23Q', stats)
+
+    values = (rx_bytes, rx_packets, rx_errors, rx_dropped + rx_missed_errors, rx_fifo_errors,
+              rx_length_errors + rx_over_errors + rx_crc_errors + rx_frame_errors, rx_compressed, multicast,
+              tx_bytes, tx_packets, tx_errors, tx_dropped, tx_fifo_errors, collisions,
+              tx_carrier_errors + tx_aborted_errors + tx_window_errors + tx_heartbeat_errors, tx_compressed)
+
+    return dict(zip(DEV_FIELDS, [float(x) for x in values]))
+
+
+def link_status(iface=None):
+    '''
+    Same dict as net_dev_status(), fetched as 64 bits counters over rtnetlink
+    (RTM_GETLINK, IFLA_STATS64) instead of parsing /proc/net/dev text. With iface
+    only that interface is requested, by its ifindex.
+    '''
+    flags = NLM_F_REQUEST | NLM_F_DUMP
+    index = 0
+
+    if iface is not None:
+        try:
+            with open('/sys/class/net/%s/ifindex' % iface, 'r') as index_file:
+                index = int(index_file.read())
+        except (IOError, ValueError):
+            return {}
+        flags = NLM_F_REQUEST
+
+    request = struct.pack('=BxHiII', socket.AF_UNSPEC, 0, index, 0, 0)
+    message = struct.pack('=IHHII', 16 + len(request), RTM_GETLINK, flags, 1, 0) + request
+
+    status = {}
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_ROUTE)
+    try:
+        sock.sendto(message, (0, 0))
+
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+
+            while offset < len(data):
+                length, msg_type = struct.unpack_from('=IH', data, offset)
+
+                if msg_type == NLMSG_DONE:
+                    return status
+
+                if msg_type == NLMSG_ERROR:
+                    error = -struct.unpack_from('=i', data, offset + 16)[0]
+                    raise socket.error(error, os.strerror(error))
+
+                name, counters = None, None
+                attribute = offset + 32                 # nlmsghdr + ifinfomsg.
+
+                while attribute < offset + length:
+                    attr_length, attr_type = struct.unpack_from('=HH', data, attribute)
+
+                    if attr_type == IFLA_IFNAME:
+                        name = data[attribute + 4:attribute + attr_length].rstrip('\0')
+                    elif attr_type == IFLA_STATS64:
+                        counters = _stats64_counters(data[attribute + 4:attribute + attr_length])
+
+                    attribute += (attr_length + 3) & ~3
+
+                if name is not None and counters is not None:
+                    status[name] = counters
+
+                if iface is not None:                   # a single reply, no NLMSG_DONE follows.
+                    return status
+
+                offset += (length + 3) & ~3
+    finally:
+        sock.close()
+
+
+def iface_status(iface):
+    return net_dev_status().get(iface, False)
 
 
 def valid_iface(device):
-    regex = re.compile(r'(?P<iface>\w+\d):.*?')
-    output = read_procfs()
-    iface_list = regex.findall(output)
+    return device in net_dev_status()
 
-    if device in iface_list:
-        return True
-    else:
-        return False
+
+def select_ifaces(devices, status):
+    ''' Interfaces of status matching a comma separated list of names or glob patterns. '''
+    patterns = [x.strip() for x in devices.split(',') if x.strip()]
+
+    return sorted(iface for iface in status if any(fnmatch.fnmatchcase(iface, pattern) for pattern in patterns))
 
 
 def diff_checks(first, second):
-    diff = deepcopy(second)
+    '''
+    second - first for every counter, allowing for 32 or 64 bits counters that
+    wrapped around. A counter that went back by more than half its range was
+    reset (ie: interface recreated) and counts from zero.
+    '''
+    diff = {}
+
+    for k, v in second.iteritems():
+        delta = v - first[k]
+
+        if delta < 0:
+            modulus = 2 ** 32 if first[k] < 2 ** 32 else 2 ** 64
+            delta += modulus
 
-    for k, v in first.iteritems():
-        diff[k] -= v
+            if delta > modulus / 2:
+                delta = v
+
+        diff[k] = delta
 
     return diff
 
@@ -74,18 +194,165 @@ def calc_one_second(diff, interval):
     return usage
 
 
+def monotonic():
+    ''' Seconds elapsed since an arbitrary point in the past, not affected by wall clock changes. '''
+    return os.times()[4]
+
+
+def take_sample(collect=net_dev_status):
+    ''' (timestamp, counters) where timestamp is the monotonic time in the middle of the read. '''
+    before = monotonic()
+    status = collect()
+
+    return (before + monotonic()) / 2, status
+
+
+def default_state_file():
+    return os.path.join(tempfile.gettempdir(), 'check_network.%d.state' % os.getuid())
+
+
+def _open_private(path, flags):
+    '''
+    Opens path only if it is a regular file of ours that nobody else can write,
+    the default state file lives in the shared temporary directory. Raises
+    OSError otherwise.
+    '''
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0600)
+    info = os.fstat(fd)
+
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 022:
+        os.close(fd)
+        raise OSError(errno.EPERM, 'untrusted state file', path)
+
+    return fd
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _valid_sample(sample):
+    ''' True for a [timestamp, counters] pair as saved by check_ifaces_stateful(). '''
+    if not isinstance(sample, list) or len(sample) != 2 or not _is_number(sample[0]) or not isinstance(sample[1], dict):
+        return False
+
+    return all(_is_number(sample[1].get(k)) for k in DEV_FIELDS)
+
+
+def load_state(state_file):
+    ''' State saved by a previous run, None when missing or untrusted. Malformed interface entries are left out. '''
+    try:
+        with os.fdopen(_open_private(state_file, os.O_RDONLY), 'r') as data_file:
+            state = json.load(data_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(state, dict):
+        return None
+
+    return dict((iface, sample) for iface, sample in state.iteritems() if _valid_sample(sample))
+
+
+def lock_state(state_file):
+    ''' Exclusive lock on state_file + .lock, held until the returned file is closed. Exits UNKNOWN when not possible. '''
+    try:
+        lock_file = os.fdopen(_open_private(state_file + '.lock', os.O_WRONLY | os.O_CREAT), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+        print 'ERROR: Fail while locking network state: %s' % e
+        exit(UNKNOWN)
+
+    return lock_file
+
+
+def save_state(state_file, state):
+    ''' Write state to a temporary file renamed over state_file, so readers never see a partial write. '''
+    fd, temp_file = tempfile.mkstemp(prefix='.check_network.', dir=os.path.dirname(os.path.abspath(state_file)))
+    try:
+        with os.fdopen(fd, 'w') as data_file:
+            json.dump(state, data_file)
+        os.rename(temp_file, state_file)
+    except (IOError, OSError):
+        os.unlink(temp_file)
+        raise
+
+
+def calc_ifaces(ifaces, first, second):
+    '''
+    kB/s and packets per second of every interface in ifaces between the samples
+    first and second, dicts of iface: (timestamp, counters). Rates are divided by
+    the time really elapsed between the two reads of each interface.
+    '''
+    usage = {}
+
+    for iface in ifaces:
+        if iface in first and iface in second:
+            elapsed = second[iface][0] - first[iface][0]
+
+            if elapsed > 0:
+                diff = diff_checks(first[iface][1], second[iface][1])
+                usage[iface] = calc_one_second(diff, elapsed)
+                usage[iface]['total_bytes'] = usage[iface]['tx_bytes'] + usage[iface]['rx_bytes']
+
+    return usage
+
+
+def _per_iface(sample):
+    timestamp, status = sample
+    return dict((iface, (timestamp, counters)) for iface, counters in status.iteritems())
+
+
 def check_iface(device, interval):
-    first_check = iface_status(device)
+    return check_ifaces([device], interval).get(device, False)
+
+
+def check_ifaces(ifaces, interval, first=None, collect=net_dev_status):
+    '''
+    kB/s and packets per second of every interface in ifaces, from two reads of
+    /proc/net/dev whatever the number of interfaces. first, a take_sample()
+    result, is used as the first read when given. collect is the function
+    reading the counters.
+    '''
+    if first is None:
+        first = take_sample(collect)
     sleep(interval)
-    second_check = iface_status(device)
+    second = take_sample(collect)
 
-    if first_check and second_check:
-        diff = diff_checks(first_check, second_check)
-        net_usage = calc_one_second(diff, interval)
+    return calc_ifaces(ifaces, _per_iface(first), _per_iface(second))
 
-        return net_usage
-    else:
-        return False
+
+def check_ifaces_stateful(ifaces, interval, current, collect, state_file, max_age):
+    '''
+    Rates since the counters stored by the previous run, without sleeping.
+    Falls back to a short sleep on the first run, or when the stored counters of
+    an interface are older than max_age seconds (or from before a reboot). A lock
+    on state_file + .lock serializes concurrent runs.
+    '''
+    with lock_state(state_file):
+        previous = load_state(state_file) or {}
+        latest = _per_iface(current)
+
+        for iface in ifaces:
+            age = current[0] - previous[iface][0] if iface in previous else -1
+
+            if not STATE_MIN_AGE <= age <= max_age:
+                previous = latest
+                sleep(min(interval, STATE_MIN_AGE))
+                latest = _per_iface(take_sample(collect))
+                break
+
+        usage = calc_ifaces(ifaces, previous, latest)
+
+        state = load_state(state_file) or {}            # keep the interfaces of other runs.
+        state.update(latest)
+
+        try:
+            save_state(state_file, state)
+        except (IOError, OSError) as e:
+            print 'ERROR: Fail while saving network state: %s' % e
+            exit(UNKNOWN)
+
+    return usage
 
 
 def print_perfdata(results):
@@ -97,7 +364,17 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def print_ifaces_perfdata(usage):
+    output = ''
+
+    for iface in sorted(usage):
+        for k in ('tx_bytes', 'rx_bytes', 'tx_packets', 'rx_packets', 'total_bytes'):
+            output += '\'%s_%s\'=%.2f ' % (iface, k, usage[iface][k])
+
+    return output
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="""Icinga plugin to check
     network interfaces on Linux. Calculates network utilization in kB/s and
     packets per second. Generates an alert if values are greater than your
@@ -108,21 +385,33 @@ def main():
         help='Warning threshold. Returns warning if interface transfer is greater than this value. Default is 256 kB/s.')
     parser.add_argument('-c', '--critical', action='store', dest='critical_threshold', type=int, default=512,
         help='Critical threshold. Returns critical if interface transfer is greater than this value. Default is 512 kB/s.')
-    parser.add_argument('-i', '--interval', action='store', dest='interval', type=int, default=1,
-        help='Time delay in seconds between collect networking information. Default is 1.')
+    parser.add_argument('-i', '--interval', action='store', dest='interval', type=float, default=1,
+        help='Time delay in seconds between collect networking information, fractions allowed. Default is 1.')
+    parser.add_argument('-s', '--stateful', action='store_true', dest='stateful',
+        help='Report rates since the previous run, kept in a state file, instead of sleeping. The first run, or a run after stale counters, sleeps 1 second.')
+    parser.add_argument('--state-file', action='store', dest='state_file', type=str, default=default_state_file(),
+        help='State file used by --stateful. Default is check_network.<uid>.state in the temporary directory.')
+    parser.add_argument('--max-age', action='store', dest='max_age', type=int, default=900,
+        help='Seconds after which --stateful counters are too old to be used. Default is 900.')
     parser.add_argument('-d', '--device', action='store', dest='device', required=True, type=str,
-        help='Network device name, ie: eth0, wlan1.')
+        help='Network device name, ie: eth0, wlan1. Also accepts a comma separated list of names and glob patterns, ie: eth0,veth*.')
+    parser.add_argument('--netlink', action='store_true', dest='netlink',
+        help='Read 64 bits interface counters over rtnetlink instead of /proc/net/dev. Falls back to /proc/net/dev when unavailable.')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
         help='No alert, only check interface and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     warning = arguments.warning_threshold
     critical = arguments.critical_threshold
     interval = arguments.interval
     noalert = arguments.noalert
     device = arguments.device
+    netlink = arguments.netlink
+    stateful = arguments.stateful
+    state_file = arguments.state_file
+    max_age = arguments.max_age
 
     if warning > critical:
         print 'ERROR: warning threshold greater than critical threshold.'
@@ -132,42 +421,78 @@ def main():
         print 'ERROR: warning and critical threshold are equal.'
         exit(UNKNOWN)
 
-    if valid_iface(device):
-        iface_usage = check_iface(device, interval)
-
-        if iface_usage:
-            iface_usage['total_bytes'] = iface_usage['tx_bytes'] + iface_usage['rx_bytes']
-
-            if iface_usage['total_bytes'] <= warning or noalert:
-                print '%s %s TX %.2f kB/s RX %.2f kB/s, TX %.2f pkts/s RX %.2f pkts/s | %s' % (
-                    device, 'OK', iface_usage['tx_bytes'],
-                    iface_usage['rx_bytes'], iface_usage['tx_packets'],
-                    iface_usage['rx_packets'], print_perfdata(iface_usage)
-                    )
-                exit(OK)
-
-            if iface_usage['total_bytes'] > warning and iface_usage['total_bytes'] < critical:
-                print '%s %s TX %.2f kB/s RX %.2f kB/s, TX %.2f pkts/s RX %.2f pkts/s | %s' % (
-                    device, 'WARNING', iface_usage['tx_bytes'],
-                    iface_usage['rx_bytes'], iface_usage['tx_packets'],
-                    iface_usage['rx_packets'], print_perfdata(iface_usage)
-                    )
-                exit(WARNING)
-
-            if iface_usage['total_bytes'] >= critical:
-                print '%s %s TX %.2f kB/s RX %.2f kB/s, TX %.2f pkts/s RX %.2f pkts/s | %s' % (
-                    device, 'CRITICAL', iface_usage['tx_bytes'],
-                    iface_usage['rx_bytes'], iface_usage['tx_packets'],
-                    iface_usage['rx_packets'], print_perfdata(iface_usage)
-                    )
-                exit(CRITICAL)
-        else:
-            print 'ERROR: Failed while get interface statistics'
-            exit(UNKNOWN)
-    else:
+    if interval <= 0:
+        print 'ERROR: interval must be greater than zero.'
+        exit(UNKNOWN)
+
+    collect = net_dev_status
+
+    if netlink:
+        # A single interface name is requested alone, lists and patterns need a dump.
+        name = None if any(c in device for c in ',*?[') else device
+        collect = lambda: link_status(name)
+
+        try:
+            first = take_sample(collect)
+        except (socket.error, AttributeError):          # no AF_NETLINK, fall back to /proc/net/dev.
+            collect = net_dev_status
+
+    if collect is net_dev_status:
+        first = take_sample(collect)
+
+    ifaces = select_ifaces(device, first[1])
+
+    if not ifaces:
         print 'ERROR: %s is not a valid network interface.' % device
         exit(UNKNOWN)
 
+    if stateful:
+        usage = check_ifaces_stateful(ifaces, interval, first, collect, state_file, max_age)
+    else:
+        usage = check_ifaces(ifaces, interval, first, collect)
+
+    if not usage:
+        print 'ERROR: Failed while get interface statistics'
+        exit(UNKNOWN)
+
+    if len(ifaces) == 1:
+        name, details = ifaces[0], ''
+        iface_usage = usage[name]
+        perfdata = print_perfdata(iface_usage)
+        transfer = iface_usage['total_bytes']
+    else:
+        # Aggregate of all interfaces, thresholds tested against the busiest one.
+        busiest = max(usage, key=lambda iface: usage[iface]['total_bytes'])
+        name = '%d interfaces' % len(usage)
+        details = ', busiest %s %.2f kB/s' % (busiest, usage[busiest]['total_bytes'])
+        iface_usage = dict((k, sum(x[k] for x in usage.values())) for k in usage[busiest])
+        perfdata = print_perfdata(iface_usage) + print_ifaces_perfdata(usage)
+        transfer = usage[busiest]['total_bytes']
+
+    if transfer <= warning or noalert:
+        print '%s %s TX %.2f kB/s RX %.2f kB/s, TX %.2f pkts/s RX %.2f pkts/s%s | %s' % (
+            name, 'OK', iface_usage['tx_bytes'],
+            iface_usage['rx_bytes'], iface_usage['tx_packets'],
+            iface_usage['rx_packets'], details, perfdata
+            )
+        exit(OK)
+
+    if transfer > warning and transfer < critical:
+        print '%s %s TX %.2f kB/s RX %.2f kB/s, TX %.2f pkts/s RX %.2f pkts/s%s | %s' % (
+            name, 'WARNING', iface_usage['tx_bytes'],
+            iface_usage['rx_bytes'], iface_usage['tx_packets'],
+            iface_usage['rx_packets'], details, perfdata
+            )
+        exit(WARNING)
+
+    if transfer >= critical:
+        print '%s %s TX %.2f kB/s RX %.2f kB/s, TX %.2f pkts/s RX %.2f pkts/s%s | %s' % (
+            name, 'CRITICAL', iface_usage['tx_bytes'],
+            iface_usage['rx_bytes'], iface_usage['tx_packets'],
+            iface_usage['rx_packets'], details, perfdata
+            )
+        exit(CRITICAL)
+
 
 
 if __name__ == '__main__':
@@ -6,7 +6,14 @@ http://github.com/viniciusfs/check_plugins
 """
 
 import argparse
-import re
+import errno
+import fcntl
+import heapq
+import marshal
+import os
+import stat
+import tempfile
+import time
 
 from sys import exit
 
@@ -15,6 +22,10 @@ OK = 0
 WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+CACHE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()    # tmpfs, see _cached().
+_CACHE_STATS = {'cache_hits': 0, 'cache_misses': 0}
 
 
 
@@ -30,30 +41,212 @@ def read_procfs():
         exit(UNKNOWN)
 
 
-def swap_status():
-    regex = re.compile(r'SwapTotal:\s+(?P<total>\d+)\skB\nSwapFree:\s+(?P<free>\d+)\skB\n')
-    output = read_procfs()
-    match = regex.search(output)
+def meminfo_status(output=None):
+    '''
+    Parses /proc/meminfo into a dict of field name to value in kB, in a single
+    pass that does not depend on the order of the fields. Pass output to parse
+    contents already read.
+    '''
+    if output is None:
+        output = read_procfs()
 
-    if match:
-        status = dict((k, float(v)) for k, v in match.groupdict().iteritems())
-        return status
-    else:
+    status = {}
+
+    for line in output.splitlines():
+        fields = line.split()
+
+        if len(fields) >= 2 and fields[0].endswith(':'):
+            try:
+                status[fields[0][:-1]] = float(fields[1])
+            except ValueError:
+                pass
+
+    return status
+
+
+def swap_status(meminfo=None):
+    if meminfo is None:
+        meminfo = meminfo_status()
+
+    try:
+        return { 'total': meminfo['SwapTotal'], 'free': meminfo['SwapFree'] }
+    except KeyError:
         return False
 
 
-def check_swap():
-    swap_usage = swap_status()
+def check_swap(meminfo=None):
+    swap_usage = swap_status(meminfo)
 
     if swap_usage:
-        swap_usage['perc_inuse'] = 100 - (swap_usage['free'] / swap_usage['total']) * 100
         swap_usage['used'] = swap_usage['total'] - swap_usage['free']
+        swap_usage['perc_inuse'] = (swap_usage['used'] / swap_usage['total']) * 100 if swap_usage['total'] else 0.0
 
         return swap_usage
     else:
         return False
 
 
+def monotonic():
+    ''' Seconds elapsed since an arbitrary point in the past, not affected by wall clock changes. '''
+    return os.times()[4]
+
+
+def pid_swap(pid):
+    '''
+    (command, swap in kB) of a process from /proc/<pid>/status, None if it is
+    gone or is a kernel thread. Reading stops at the VmSwap line.
+    '''
+    command = None
+
+    try:
+        with open('/proc/%s/status' % pid, 'r') as data_file:
+            for line in data_file:
+                if line.startswith('Name:'):
+                    command = line[5:].strip()
+                elif line.startswith('VmSwap:'):
+                    return command, int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+
+    return None
+
+
+def top_swap(top, budget):
+    '''
+    The top processes by swap in use, as (kB, pid, command), largest first. The
+    scan of /proc stops after budget seconds, returns the top list and whether
+    every process was scanned.
+    '''
+    deadline = monotonic() + budget
+    heap = []                                           # smallest of the top on heap[0].
+
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+
+        if monotonic() > deadline:
+            return sorted(heap, reverse=True), False
+
+        sample = pid_swap(pid)
+        if not sample or not sample[1]:
+            continue
+
+        entry = (sample[1], pid, sample[0])
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    return sorted(heap, reverse=True), True
+
+
+def print_top(processes, complete):
+    ''' Long output lines of top_swap(). '''
+    lines = '\n'.join('%s %s %d kB' % (pid, command, swap) for swap, pid, command in processes)
+
+    if not complete:
+        lines += '\nProcess scan stopped by time budget.'
+
+    return lines
+
+
+def _open_cache(path, flags):
+    '''
+    Opens a file of CACHE_DIR, where anyone may create files, only if it is a
+    regular file of ours that nobody else can write. Raises OSError otherwise.
+    '''
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0600)
+    info = os.fstat(fd)
+
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 022:
+        os.close(fd)
+        raise OSError(errno.EPERM, 'untrusted cache file', path)
+
+    return fd
+
+
+def _read_cache(path, ttl):
+    try:
+        fd = _open_cache(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        with os.fdopen(fd, 'rb') as data_file:
+            if time.time() - os.fstat(fd).st_mtime < ttl:
+                return marshal.load(data_file)
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        pass
+
+    return None
+
+
+def _write_cache(path, value):
+    try:
+        fd, temp_file = tempfile.mkstemp(prefix='.check_plugins.', dir=CACHE_DIR)
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as data_file:
+            marshal.dump(value, data_file)
+        os.rename(temp_file, path)
+    except (IOError, OSError, ValueError):
+        os.unlink(temp_file)
+
+
+def _lock_cache(path):
+    ''' Locked file descriptor of path, None when it can not be opened or locked. '''
+    try:
+        fd = _open_cache(path, os.O_WRONLY | os.O_CREAT)
+    except OSError:
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except IOError:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _cached(key, ttl, load):
+    '''
+    Result of load(), shared with other runs for ttl seconds through a file in
+    CACHE_DIR, so checks started together parse their source once. Runs finding
+    the cache stale wait on a lock for the one loading it. Cache files not owned
+    by us or writable by others are ignored, load() is used whenever the cache
+    can not be. ttl 0 disables it.
+    '''
+    if not ttl:
+        return load()
+
+    path = os.path.join(CACHE_DIR, 'check_plugins.%d.%s.cache' % (os.getuid(), key))
+    value = _read_cache(path, ttl)
+
+    if value is None:
+        lock_fd = _lock_cache(path + '.lock')
+
+        if lock_fd is None:
+            _CACHE_STATS['cache_misses'] += 1
+            return load()
+
+        try:
+            value = _read_cache(path, ttl)              # loaded by another run meanwhile.
+
+            if value is None:
+                _CACHE_STATS['cache_misses'] += 1
+                value = load()
+                _write_cache(path, value)
+                return value
+        finally:
+            os.close(lock_fd)
+
+    _CACHE_STATS['cache_hits'] += 1
+    return value
+
+
 def print_perfdata(results):
     output = ''
 
@@ -63,7 +256,7 @@ def print_perfdata(results):
     return output
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="""Icinga plugin to check the
     amount of used swap on Linux systems. It calculates swap utilization in
     percentage and generates an alert if value is greater than your thresholds.
@@ -74,11 +267,17 @@ def main():
         help='Warning threshold. Returns warning if percentage of swap usage is greater than this value. Default is 80.')
     parser.add_argument('-c', '--critical', action='store', dest='critical_threshold', type=int, default=90,
         help='Critical threshold. Returns critical if percentage of swap usage is greater than this value. Default is 90.')
+    parser.add_argument('-t', '--top', action='store', dest='top', type=int, default=0,
+        help='When a threshold is crossed, list the processes using most swap in long output. Default is 0, disabled.')
+    parser.add_argument('--top-budget', action='store', dest='top_budget', type=float, default=1,
+        help='Maximum seconds spent scanning processes for --top. Default is 1.')
+    parser.add_argument('--cache-ttl', action='store', dest='cache_ttl', type=float, default=0,
+        help='Seconds the parsed /proc/meminfo is shared with other runs through a cache in /dev/shm, with cache_hits and cache_misses in performance data. Default is 0, disabled.')
     parser.add_argument('-n', '--no-alert', action='store_true', dest='noalert',
         help='No alert, only check swap and print performance data.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1.2')
 
-    arguments = parser.parse_args()
+    arguments = parser.parse_args(argv)
 
     warning = arguments.warning_threshold
     critical = arguments.critical_threshold
@@ -92,20 +291,25 @@ def main():
         print 'ERROR: warning and critical threshold are equal.'
         exit(UNKNOWN)
 
-    swap_usage = check_swap()
+    swap_usage = check_swap(_cached('proc_meminfo', arguments.cache_ttl, meminfo_status))
+
+    if swap_usage and arguments.cache_ttl:
+        swap_usage.update(_CACHE_STATS)
 
     if swap_usage:
         if swap_usage['perc_inuse'] <= warning or noalert:
-            print 'Swap %s %.2f%% in use | %s' % ('OK', swap_usage['perc_inuse'], print_perfdata(swap_usage))
-            exit(OK)
+            status = OK
+        elif swap_usage['perc_inuse'] < critical:
+            status = WARNING
+        else:
+            status = CRITICAL
+
+        print 'Swap %s %.2f%% in use | %s' % (STATE_NAMES[status], swap_usage['perc_inuse'], print_perfdata(swap_usage))
 
-        if swap_usage['perc_inuse'] > warning and swap_usage['perc_inuse'] < critical:
-            print 'Swap %s %.2f%% in use | %s' % ('WARNING', swap_usage['perc_inuse'], print_perfdata(swap_usage))
-            exit(WARNING)
+        if status != OK and arguments.top > 0:
+            print print_top(*top_swap(arguments.top, arguments.top_budget))
 
-        if swap_usage['perc_inuse'] >= critical:
-            print 'Swap %s %.2f%% in use | %s' % ('CRITICAL', swap_usage['perc_inuse'], print_perfdata(swap_usage))
-            exit(CRITICAL)
+        exit(status)
 
 
 